@@ -16,7 +16,7 @@ filterwarnings("ignore")
 from src.tokenization import build_tokenizer
 from src.data import build_dataset, build_loader
 from src.model import build_model_from_scratch, DECODER_BASED
-from src.evaluate import get_tokenwise_accuracy, get_instancewise_accuracy, get_parity_accuracy, get_answerwise_accuracy
+from src.evaluate import get_tokenwise_accuracy, get_instancewise_accuracy, get_parity_accuracy, get_answerwise_accuracy, get_generation_accuracy
 
 def evaluate(args):    
     args = DotMap(args)
@@ -27,6 +27,7 @@ def evaluate(args):
     max_n_digits = args.max_n_digits
     eval_step = args.step_digits
     compile = args.compile
+    generate = args.generate
 
     # Hydra Compose
     initialize(version_base=None, config_path=config_path) 
@@ -112,6 +113,8 @@ def evaluate(args):
     answerwise_accuracies = []
     if is_parity:
         parity_accuracies = []
+    if generate:
+        generation_accuracies = []
 
     for n_digits in reversed(range(min_n_digits, max_n_digits+1, eval_step)):
         try:
@@ -126,7 +129,7 @@ def evaluate(args):
         set_seed(seed=999)
 
         # Dataset / Dataloader
-        dataset = build_dataset(cfg,verbose=False)
+        dataset = build_dataset(cfg, verbose=False, tokenizer=tokenizer)
         loader = build_loader(cfg, dataset, tokenizer, device)
 
         phase = 'val_long'
@@ -140,6 +143,8 @@ def evaluate(args):
         answerwise_correct_sum = 0
         if is_parity:
             parity_correct_sum = 0
+        if generate:
+            generation_correct_sum = 0
         for batch_idx, model_inputs in enumerate(pbar):
             if "IndexHints" in cfg.task.train.dataset_cls and cfg.task.get('hide_index_hints', False):
                 model_inputs['labels'] = torch.where(
@@ -166,11 +171,16 @@ def evaluate(args):
                 if is_parity:
                     parity_correct, _ = get_parity_accuracy(cfg, pred, model_inputs['labels'], eos_token_id, division=False, return_arr=False)
                     parity_correct_sum += parity_correct.item()                    
+                if generate:
+                    with ctx:
+                        generation_correct, _ = get_generation_accuracy(cfg, model, model_inputs, tokenizer, division=False)
+                    generation_correct_sum += generation_correct.item()
                 pbar.set_description(f"Loss:{loss:.3g}"
                                      f" | TokenAcc:{tokenwise_correct/num_tokens:.3g}"
                                      f" | InstAcc:{instancewise_correct/batchsize:.3g}"
                                      f" | AnsAcc:{answerwise_correct/batchsize:.3g}" \
-                                     + (f" | ParityAcc:{parity_correct/batchsize:.3g}" if is_parity else "")) 
+                                     + (f" | ParityAcc:{parity_correct/batchsize:.3g}" if is_parity else "") \
+                                     + (f" | GenAcc:{generation_correct/batchsize:.3g}" if generate else "")) 
         
         # Logging
         loss_avg = loss_sum/len(dataset[phase])
@@ -179,18 +189,23 @@ def evaluate(args):
         answerwise_accuracy_avg = answerwise_correct_sum/len(dataset[phase])
         if is_parity:
             parity_accuracy_avg = parity_correct_sum/len(dataset[phase])
+        if generate:
+            generation_accuracy_avg = generation_correct_sum/len(dataset[phase])
         print(f"seed({cfg.seed},{cfg.seed_data}) N={n_digits}"
               f" Loss {loss_avg:.6f}"
               f" TokenAcc {tokenwise_accuracy_avg:.6f}"
               f" InstAcc {instancewise_accuracy_avg:.6f}"
               f" AnsAcc {answerwise_accuracy_avg:.6f}" \
-              + (f" ParityAcc:{parity_accuracy_avg:.3g}\n" if is_parity else "\n"))
+              + (f" ParityAcc:{parity_accuracy_avg:.3g}" if is_parity else "") \
+              + (f" GenAcc {generation_accuracy_avg:.6f}" if generate else "") + "\n")
         losses.append(loss_avg)
         tokenwise_accuracies.append(tokenwise_accuracy_avg)
         instancewise_accuracies.append(instancewise_accuracy_avg)
         answerwise_accuracies.append(answerwise_accuracy_avg)
         if is_parity:
             parity_accuracies.append(parity_accuracy_avg)
+        if generate:
+            generation_accuracies.append(generation_accuracy_avg)
     
     # Save loggings
     X = np.arange(min_n_digits, max_n_digits+1, eval_step)
@@ -203,6 +218,8 @@ def evaluate(args):
     }
     if is_parity:
         perf_dict['parity_accuracies'] = parity_accuracies[::-1]
+    if generate:
+        perf_dict['generation_accuracies'] = generation_accuracies[::-1]
     with open(os.path.join(logging_path, f'performances_EVAL_{mode}.json'), 'w') as f:
         json.dump(perf_dict, f, indent=2)
 
@@ -215,6 +232,7 @@ if __name__ == '__main__':
     parser.add_argument('--max_n_digits',type=int,  default=100)
     parser.add_argument('--step_digits', type=int,  default=1)
     parser.add_argument('--compile',   action='store_true')
+    parser.add_argument('--generate',  action='store_true')  # also greedy-decode the answers (exact-match GenAcc)
     parser.add_argument('--overrides',   type=str,  default=[],  nargs='*')
     args = parser.parse_args()
 
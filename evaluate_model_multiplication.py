@@ -145,7 +145,7 @@ def evaluate(args):
             set_seed(seed=999)
 
             # Dataset / Dataloader
-            dataset = build_dataset(cfg, verbose=False)
+            dataset = build_dataset(cfg, verbose=False, tokenizer=tokenizer)
             loader = build_loader(cfg, dataset, tokenizer, device)
 
             phase = 'val_long'
@@ -4,13 +4,14 @@ import argparse
 from contextlib import nullcontext
 from dotmap import DotMap
 from hydra import compose, initialize
+from itertools import islice
 import json
+import logging
 import math
 import matplotlib.pyplot as plt
 from omegaconf import OmegaConf
 import os
 os.environ['CUBLAS_WORKSPACE_CONFIG'] = ':16:8'
-os.environ['CUDA_LAUNCH_BLOCKING']='1'
 os.environ['MKL_THREADING_LAYER'] = 'GNU'
 import torch
 import torchinfo
@@ -22,10 +23,11 @@ filterwarnings("ignore")
 from time import perf_counter
 
 from src.tokenization import build_tokenizer
-from src.data import build_dataset, build_loader, build_dataset_varied
+from src.data import build_dataset, build_loader, build_subset_loader, build_dataset_varied
 from src.model import build_model_from_scratch, DECODER_BASED
-from src.training import get_custom_cosine_schedule_with_warmup, get_custom_linear_schedule_with_warmup, set_seed
-from src.evaluate import get_tokenwise_accuracy, get_instancewise_accuracy
+from src.training import get_custom_cosine_schedule_with_warmup, get_custom_linear_schedule_with_warmup, set_seed, RunningMetrics, split_microbatches
+from src.training import CheckpointWriter, load_checkpoint, find_latest_checkpoint, get_checkpoint_path, get_rng_state, set_rng_state
+from src.evaluate import get_tokenwise_accuracy, get_instancewise_accuracy, get_teacher_forced_accuracy
 from src.common import print_example, print_2D
 
 
@@ -38,22 +40,39 @@ def run(args):
     # Hydra Compose
     initialize(version_base=None, config_path=config_path) 
     cfg = compose(config_name=config_name, overrides=overrides)
+    if cfg.get('debug_samples', 0):
+        logging.basicConfig(format="(debug) %(message)s")
+        logging.getLogger('src.data').setLevel(logging.DEBUG)
 
     logging_path = os.path.join("log", cfg.group_name, cfg.exp_name, f"seed{cfg.seed}_seedData{cfg.seed_data}")
     if not os.path.exists(logging_path):
         os.makedirs(logging_path)
 
+    # Resume (`resume=auto`: from the latest checkpoint of this run, if any; or `resume=<path of a checkpoint>`)
+    resume = cfg.get('resume', None)
+    resume_path = find_latest_checkpoint(logging_path) if resume == 'auto' else resume
+    resume_state = None
+    if resume_path is not None:
+        print(f"resuming from {resume_path}")
+        resume_state = load_checkpoint(resume_path)
+    elif resume == 'auto':
+        print(f"resume=auto: no checkpoint in {logging_path}, training from scratch")
+
     # WandB
     dict_cfg = OmegaConf.to_container(cfg, resolve=True, throw_on_missing=True)
     use_wandb = cfg.use_wandb
     if use_wandb:
+        wandb_resume = {}
+        if resume_state is not None and resume_state['wandb_run_id'] is not None:
+            wandb_resume = dict(id=resume_state['wandb_run_id'], resume='allow')
         run = wandb.init(
             project=cfg.project_name, 
             entity=cfg.entity,
             config=dict_cfg,
             group=cfg.exp_name,
             reinit=True,
-            settings=wandb.Settings(start_method="thread")
+            settings=wandb.Settings(start_method="thread"),
+            **wandb_resume
         ) 
     else:
         with open(os.path.join(logging_path, 'cfg.json'), 'w') as f:
@@ -109,9 +128,9 @@ def run(args):
     if cfg['task']['train']['dataset_cls'] == "VariedDatasetWithCoupledPositions":
         dataset = build_dataset_varied(cfg)
     else:
-        dataset = build_dataset(cfg)
+        dataset = build_dataset(cfg, tokenizer=tokenizer)
 
-    loader = build_loader(cfg, dataset, tokenizer, device)
+    loader = build_loader(cfg, dataset, tokenizer, device, num_workers=cfg.training.get('num_workers', 0))
 
     # Random seed for model & training
     set_seed(seed=cfg.seed, device_type=device_type)
@@ -120,6 +139,9 @@ def run(args):
     model = build_model_from_scratch(cfg, tokenizer, device)
     if getattr(cfg.model, 'compile', True):
         model = torch.compile(model)  # compile!
+        if hasattr(model._orig_mod, 'forward_eval'):
+            # (model.forward_eval would resolve to the uncompiled model._orig_mod.forward_eval)
+            model.forward_eval = torch.compile(model._orig_mod.forward_eval)
     model_summary = torchinfo.summary(model, depth=5)
     dict_cfg['total_params'] = model_summary.total_params
     dict_cfg['trainable_params'] = model_summary.trainable_params
@@ -163,9 +185,18 @@ def run(args):
     # Training Misc
     model_name = cfg.model.model_name
     calc_acc_every_epochs = cfg.training.calc_acc_every_epochs
+    log_every_steps = cfg.training.get('log_every_steps', 100)
     min_val_loss = 1e10
     grad_clip = cfg.training.grad_clip
+    gradient_accumulation_steps = cfg.training.get('gradient_accumulation_steps', 1)
+    max_tokens_per_microbatch = cfg.training.get('max_tokens_per_microbatch', None)
     save = cfg.model.get('save', False)
+    checkpoint_every_steps = cfg.training.get('checkpoint_every_steps', None)
+    keep_checkpoints = cfg.training.get('keep_checkpoints', 1)
+    keep_best_models = cfg.training.get('keep_best_models', 1)
+    # model/checkpoint files are written in the background; finished writes (path, blocking_sec, write_sec)
+    checkpoint_writer = CheckpointWriter()
+    checkpoint_writes = []
 
     phases = list(loader.keys())  # ['train', 'val', 'val_long']
     phases.remove('val_long')
@@ -178,189 +209,408 @@ def run(args):
     tokenwise_accuracies = {phase: [] for phase in phases}
     instancewise_accuracies = {phase: [] for phase in phases}
     times = {phase: [] for phase in phases}
+    # results of the quick evaluations (`training.eval_batches`), kept apart from those on the whole eval sets
+    quick_losses = {phase: [] for phase in phases}
+    quick_tokenwise_accuracies = {phase: [] for phase in phases}
+    quick_instancewise_accuracies = {phase: [] for phase in phases}
 
     ## Train! ##
     counter_training = 0
 
     checkpoint_data = { key: {phase: [] for phase in phases} for key in ['losses', 'tokenwise', 'instancewise', 'times'] }
 
+    # Evaluation schedule: every calc_acc_every_epochs epochs, or every `training.eval_every_steps` training steps
+    # (step-based; the training epochs then just go on after each evaluation). With `training.eval_batches`, the
+    # evaluations are quick ones, over a fixed sample of eval_batches batches of each eval set (`build_subset_loader`),
+    # except the last one and those at the `training.full_eval_steps` milestones, over the whole eval sets.
+    # Only the full evaluations select the best model.
+    eval_every_steps = cfg.training.get('eval_every_steps', None)
+    eval_batches = cfg.training.get('eval_batches', None)
+    full_eval_steps = list(cfg.training.get('full_eval_steps', None) or [])
+    quick_loader = {}  # (built at the first quick evaluation)
+    eval_steps = []  # training step of each evaluation
+    eval_epochs = []  # epoch of each evaluation
+    eval_quick = []  # whether each evaluation is a quick one
+    train_time, eval_time = 0., 0.  # wall-clock time spent on training / evaluation
+
+    def run_batch(phase, model_inputs, metrics, calc_acc):
+        nonlocal counter_training
+        if "IndexHints" in cfg.task.train.dataset_cls and cfg.task.get('hide_index_hints', False):
+            model_inputs['labels'] = torch.where(
+                torch.logical_and(model_inputs['labels'] >= id_index_hint_begin,
+                                  model_inputs['labels'] <= id_index_hint_end),
+                -100,
+                model_inputs['labels']
+            )
+        # training batches may be split into micro-batches (gradient accumulation, src/training/microbatch.py)
+        microbatches = [(model_inputs, None)]
+        if phase == 'train' and (gradient_accumulation_steps > 1 or max_tokens_per_microbatch):
+            microbatches = split_microbatches(
+                model_inputs,
+                n_microbatches=gradient_accumulation_steps,
+                max_tokens=max_tokens_per_microbatch,
+                trim=model_name in DECODER_BASED,
+                shift_labels=model_name in DECODER_BASED,
+            )
+        values = {}
+        for inputs, weight in microbatches:
+            with torch.set_grad_enabled(phase == 'train'):
+                with ctx:
+                    if phase != 'train' and hasattr(model, 'forward_eval'):
+                        # logits at the label tokens only (CustomDecoderOnlyT5)
+                        model_output = model.forward_eval(**inputs)
+                    else:
+                        model_output = model(**inputs)
+                    loss = model_output.loss
+                    if weight is not None:
+                        loss = loss * weight  # (the micro-batch share of the batch loss)
+                if phase == 'train':
+                    if scaler is not None:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+            with torch.no_grad():
+                micro_values = dict(loss=loss.detach().float())
+                if calc_acc:
+                    if getattr(model_output, 'instance_correct', None) is not None:
+                        tokenwise_correct, num_tokens, instancewise_correct, _ = get_teacher_forced_accuracy(model_output, tokenizer.pad_token_id)
+                    else:
+                        pred = torch.argmax(model_output.logits, dim=-1)
+                        tokenwise_correct, num_tokens = get_tokenwise_accuracy(cfg, pred, inputs['labels'], tokenizer.pad_token_id, division=False)
+                        instancewise_correct, _ = get_instancewise_accuracy(cfg, pred, inputs['labels'], tokenizer.pad_token_id, division=False, segment_ids=inputs.get('segment_ids'))
+                    micro_values.update(tokenwise_correct=tokenwise_correct, num_tokens=num_tokens, instancewise_correct=instancewise_correct)
+                for k, v in micro_values.items():
+                    values[k] = values[k] + v if k in values else v
+            del model_output, loss
+        if phase == 'train':
+            # one optimizer step per batch, on the accumulated gradients
+            if scaler is not None:
+                if grad_clip > 0.:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                if grad_clip > 0.:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            scheduler.step()
+            counter_training += 1
+        with torch.no_grad():
+            batchsize = len(model_inputs['input_ids'])
+            if 'segment_ids' in model_inputs:
+                # packed rows (`training.packing`): count examples, not rows
+                batchsize = model_inputs['segment_ids'].max(dim=1).values.sum()
+            n_tokens = model_inputs['attention_mask'].sum() if 'attention_mask' in model_inputs else model_inputs['input_ids'].numel()
+            values['loss_sum'] = values.pop('loss') * batchsize
+            metrics.update(n_tokens=n_tokens, n_samples=batchsize, **values)
+
+    def log_running_metrics(phase, pbar, metrics, calc_acc):
+        # running sums kept on the device are only synced here, every log_every_steps batches (see `RunningMetrics`)
+        summary = metrics.summary()
+        description = f"[{counter_training}/{n_steps}] {phase.upper()} | LR:{scheduler.get_last_lr()[0]:.3g} | Loss:{summary['loss_sum']/summary['n_samples']:.3f}"
+        if calc_acc:
+            description += f" | TokenAcc:{summary['tokenwise_correct']/summary['num_tokens']:.3f} | InstAcc:{summary['instancewise_correct']/summary['n_samples']:.3f}"
+        description += f" | {summary['steps_per_sec']:.3g} steps/s | {summary['tokens_per_sec']:.3g} tokens/s"
+        pbar.set_description(description)
+        if use_wandb and phase == 'train':
+            run.log({
+                'train/running_loss': summary['loss_sum']/summary['n_samples'],
+                'misc/learning_rate': scheduler.get_last_lr()[0],
+                'misc/steps_per_sec': summary['steps_per_sec'],
+                'misc/tokens_per_sec': summary['tokens_per_sec'],
+            }, step=counter_training)
+        if phase == 'train':
+            log_checkpoint_writes()
+
+    def log_checkpoint_writes():
+        # latency of the checkpoint writes finished since the last call
+        completed = checkpoint_writer.pop_completed()
+        checkpoint_writes.extend(completed)
+        if use_wandb and completed:
+            run.log({
+                'misc/checkpoint_blocking_sec': max(write['blocking_sec'] for write in completed),
+                'misc/checkpoint_write_sec': max(write['write_sec'] for write in completed),
+            }, step=counter_training)
+
+    def log_phase(epoch, phase, summary, phase_time, log_acc, quick=False):
+        # Logging at the end of epoch (or of the training steps since the last evaluation, with eval_every_steps)
+        # quick: results of a quick evaluation (on a sample of the eval set)
+        nonlocal min_val_loss
+        n_samples = summary['n_samples']
+        loss_avg = summary['loss_sum']/n_samples
+        (quick_losses if quick else losses)[phase].append(loss_avg)
+        tokenwise_accuracy_avg = instancewise_accuracy_avg = float('nan')
+        if log_acc:
+            tokenwise_accuracy_avg = summary['tokenwise_correct']/summary['num_tokens']
+            instancewise_accuracy_avg = summary['instancewise_correct']/n_samples
+            (quick_tokenwise_accuracies if quick else tokenwise_accuracies)[phase].append(tokenwise_accuracy_avg)
+            (quick_instancewise_accuracies if quick else instancewise_accuracies)[phase].append(instancewise_accuracy_avg)
+            # if getattr(cfg.model, 'd_positions', None) is None:
+            #     _, _, _, example = print_example(cfg, ctx, epoch, phase, tokenizer, dataset, model, verbose=False)
+            #     print(example)
+
+        # log checkpoint data
+        print(f"({epoch=}): logging data for {phase}... {loss_avg:.3g} | {tokenwise_accuracy_avg:.3g} | {instancewise_accuracy_avg:.3g} | {phase_time:.3g}")
+        checkpoint_data['losses'][phase].append(loss_avg)
+        checkpoint_data['tokenwise'][phase].append(tokenwise_accuracy_avg)
+        checkpoint_data['instancewise'][phase].append(instancewise_accuracy_avg)
+        checkpoint_data['times'][phase].append(phase_time)
+
+        # W&B
+        if use_wandb:
+            log_data = {'loss': loss_avg}
+            if log_acc:
+                log_data['tokenwise_accuracy'] = tokenwise_accuracy_avg
+                log_data['instancewise_accuracy'] = instancewise_accuracy_avg
+                # if getattr(cfg.model, 'd_positions', None) is None:
+                #     log_data['example'] = example
+            log_data = {f"{phase}{'_quick' if quick else ''}/{k}": v for k, v in log_data.items()}
+            if phase == 'train':
+                log_data['misc/learning_rate'] = scheduler.get_last_lr()[0]
+            run.log(log_data, step=counter_training)
+        # Print result of epoch
+        name = phase.upper() + (" (quick)" if quick else "")
+        if log_acc:
+            print(f"Epoch {epoch}/{n_epochs} {name} Loss {loss_avg:.6f} "
+                  f"TokenAcc {tokenwise_accuracy_avg:.6f} "
+                  f"InstAcc {instancewise_accuracy_avg:.6f}")
+        else:
+            print(f"Epoch {epoch}/{n_epochs} {name} Loss {loss_avg:.6f} ")
+
+        # Plot results
+        if phase == phases[-1] and log_acc:
+            def x_axis(values, p, quick=False):
+                # training steps (step-based evaluation) or epochs
+                if p != 'train':
+                    # the evaluations of the same kind (full / quick)
+                    x = [x for x, q in zip(eval_steps if eval_every_steps else eval_epochs, eval_quick) if q == quick]
+                    return x[-len(values):]
+                return eval_steps[-len(values):] if eval_every_steps else torch.arange(1,len(values)+1).numpy()*calc_acc_every_epochs
+            for title, filename, full_values, quick_values, best in [
+                ("Loss", "loss.pdf", losses, quick_losses, min),
+                ("Tokenwise Accuracy", "tokenwise_accuracy.pdf", tokenwise_accuracies, quick_tokenwise_accuracies, max),
+                ("Instance-wise Accuracy", "instancewise_accuracy.pdf", instancewise_accuracies, quick_instancewise_accuracies, max),
+            ]:
+                fig, ax = plt.subplots(1,1)
+                plot = ax.semilogy if title == "Loss" else ax.plot
+                for p in phases:
+                    for values, quick_series in [(full_values[p], False), (quick_values[p], True)]:
+                        if not values: continue
+                        plot(x_axis(values, p, quick_series),
+                             values,
+                             label=p+(" (quick)" if quick_series else "")+f" (Final:{values[-1]:.3g} | {best.__name__.capitalize()}:{best(values):.3g})",
+                             marker='x' if quick_series else '.',
+                             linestyle=':' if quick_series else '-')
+                ax.legend()
+                ax.set_title(title)
+                fig.savefig(os.path.join(logging_path, filename))
+                plt.close(fig)
+        # Save Best Model (in terms of min val_long loss, over the whole eval set)
+        if save and phase == 'val_long' and not quick and min_val_loss > losses['val_long'][-1]:
+            min_val_loss = losses['val_long'][-1]
+            best_path = os.path.join(logging_path, f"best_{model_name}.pt")
+            if keep_best_models > 1:
+                # the best keep_best_models models as best_{model_name}_{step}.pt (best_{model_name}.pt: the best one)
+                checkpoint_writer.save(model.state_dict(), get_checkpoint_path(logging_path, counter_training, prefix=f"best_{model_name}"),
+                                       keep=keep_best_models, alias=best_path)
+            else:
+                checkpoint_writer.save(model.state_dict(), best_path)
+
+    def evaluate(epoch, log_acc):
+        # all the eval phases, quick (eval_batches batches) unless last or past a full_eval_steps milestone
+        nonlocal eval_time
+        previous_step = eval_steps[-1] if eval_steps else 0
+        full = eval_batches is None or counter_training >= n_steps or (epoch == n_epochs and not eval_every_steps) \
+            or any(previous_step < s <= counter_training for s in full_eval_steps)
+        eval_steps.append(counter_training)
+        eval_epochs.append(epoch)
+        eval_quick.append(not full)
+        start_t = perf_counter()
+        batch_counts = {}
+        for phase in phases:
+            if phase == 'train': continue
+            model.eval()
+            if not full and phase not in quick_loader:
+                quick_loader[phase] = build_subset_loader(loader[phase], eval_batches)
+            eval_loader = loader[phase] if full else quick_loader[phase]
+            n_batches = len(eval_loader)
+            batch_counts[phase] = n_batches if full else f"{n_batches}/{len(loader[phase])}"
+            if hasattr(dataset[phase], 'set_epoch'):
+                dataset[phase].set_epoch(epoch)
+
+            pbar = tqdm(eval_loader)
+            metrics = RunningMetrics()
+            _start_t = perf_counter()
+            for batch_idx, model_inputs in enumerate(pbar):
+                run_batch(phase, model_inputs, metrics, calc_acc=True)
+                if (batch_idx + 1) % log_every_steps == 0 or batch_idx + 1 == n_batches:
+                    log_running_metrics(phase, pbar, metrics, calc_acc=True)
+            summary = metrics.summary()
+            log_phase(epoch, phase, summary, perf_counter() - _start_t, log_acc, quick=not full)
+        model.train()
+
+        # compute budget spent on evaluation
+        eval_time += perf_counter() - start_t
+        eval_fraction = eval_time / max(train_time + eval_time, 1e-9)
+        n_batches = ", ".join(f"{phase} {n}" for phase, n in batch_counts.items())
+        print(f"({counter_training=}): {'full' if full else 'quick'} eval ({n_batches} batches) "
+              f"{perf_counter() - start_t:.3g}s | total eval {eval_time:.3g}s ({eval_fraction:.1%} of train+eval)")
+        if use_wandb:
+            run.log({'misc/eval_time': eval_time, 'misc/eval_time_fraction': eval_fraction}, step=counter_training)
+
+    def save_training_state(epoch, batch_idx, epoch_state):
+        # full training state after the batch batch_idx of the training epoch, see src/training/checkpoint.py
+        state = {
+            'model': getattr(model, '_orig_mod', model).state_dict(),  # torch.compile
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'scaler': scaler.state_dict() if scaler is not None else None,
+            'counter_training': counter_training,
+            'epoch': epoch,
+            'batch_idx': batch_idx,
+            'epoch_state': epoch_state,
+            'rng_state': get_rng_state(),
+            'train_metrics': train_metrics.state_dict(),
+            'segment_time': _segment_t,
+            'logs': {
+                'losses': losses,
+                'tokenwise_accuracies': tokenwise_accuracies,
+                'instancewise_accuracies': instancewise_accuracies,
+                'quick_losses': quick_losses,
+                'quick_tokenwise_accuracies': quick_tokenwise_accuracies,
+                'quick_instancewise_accuracies': quick_instancewise_accuracies,
+                'checkpoint_data': checkpoint_data,
+                'eval_steps': eval_steps,
+                'eval_epochs': eval_epochs,
+                'eval_quick': eval_quick,
+                'min_val_loss': min_val_loss,
+                'train_time': train_time,
+                'eval_time': eval_time,
+            },
+            'wandb_run_id': run.id if use_wandb else None,
+        }
+        checkpoint_writer.save(state, get_checkpoint_path(logging_path, counter_training), keep=keep_checkpoints)
+
+    train_metrics = RunningMetrics()  # (with eval_every_steps: since the last evaluation, across epochs)
+    _segment_t = 0.
+    resume_epoch = None
+    if resume_state is not None:
+        getattr(model, '_orig_mod', model).load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        if scaler is not None and resume_state['scaler'] is not None:
+            scaler.load_state_dict(resume_state['scaler'])
+        counter_training = resume_state['counter_training']
+        resume_epoch = resume_state['epoch']
+        train_metrics.load_state_dict(resume_state['train_metrics'])
+        _segment_t = resume_state['segment_time']
+        logs = resume_state['logs']
+        for key, log in [('losses', losses), ('tokenwise_accuracies', tokenwise_accuracies),
+                         ('instancewise_accuracies', instancewise_accuracies), ('quick_losses', quick_losses),
+                         ('quick_tokenwise_accuracies', quick_tokenwise_accuracies),
+                         ('quick_instancewise_accuracies', quick_instancewise_accuracies), ('checkpoint_data', checkpoint_data)]:
+            log.update(logs[key])
+        for key, log in [('eval_steps', eval_steps), ('eval_epochs', eval_epochs), ('eval_quick', eval_quick)]:
+            log.extend(logs[key])
+        min_val_loss, train_time, eval_time = logs['min_val_loss'], logs['train_time'], logs['eval_time']
+        print(f"resumed at step {counter_training}/{n_steps} (epoch {resume_epoch}, batch {resume_state['batch_idx']+1})")
+
     for epoch in range(1, n_epochs+1):
         if counter_training >= n_steps: break
+        if resume_epoch is not None and epoch < resume_epoch: continue
+        calc_acc = epoch % calc_acc_every_epochs == 0 or epoch == n_epochs
         for phase in phases:
-            model.train(phase == 'train')
-            if phase != 'train' and not (epoch%calc_acc_every_epochs == 0 or epoch == n_epochs): continue
+            if phase != 'train':
+                # Evaluation every calc_acc_every_epochs epochs (see evaluate() for step-based evaluation)
+                if phase == phases[-1] and not eval_every_steps and calc_acc:
+                    evaluate(epoch, log_acc=epoch % calc_acc_every_epochs == 0)
+                continue
             # Training Epoch
+            model.train()
 
             print(f"\x1b[34mloader[phase] is {len(loader[phase])} batches!!\x1b[0m")
+            if hasattr(dataset[phase], 'set_epoch'):
+                dataset[phase].set_epoch(epoch)
+
+            # the order (and random positions, ...) of the batches of the epoch only depend on the RNG states and the
+            # epoch of the sampler at its start: a resumed epoch loads again the batches done before the checkpoint
+            batch_sampler = getattr(loader[phase], 'batch_sampler', None)
+            skip = 0
+            if epoch == resume_epoch:
+                epoch_state = resume_state['epoch_state']
+                set_rng_state(epoch_state['rng_state'])
+                if epoch_state['sampler_epoch'] is not None:
+                    batch_sampler.set_epoch(epoch_state['sampler_epoch'])
+                skip = resume_state['batch_idx'] + 1
+            else:
+                epoch_state = {'rng_state': get_rng_state(), 'sampler_epoch': getattr(batch_sampler, 'epoch', None)}
+            batches = iter(loader[phase])
+            if skip:
+                for _ in islice(batches, skip): pass
+                set_rng_state(resume_state['rng_state'])
 
-            pbar = tqdm(loader[phase])
-            loss_sum = 0.
-            if epoch % calc_acc_every_epochs == 0 or epoch == 1:
-                tokenwise_correct_sum = 0
-                num_tokens_sum = 0
-                instancewise_correct_sum = 0
-
-                _checkpoint_times = {phase: 0 for phase in phases}
+            pbar = tqdm(batches, total=len(loader[phase]), initial=skip)
+            if not eval_every_steps and not skip:
+                train_metrics = RunningMetrics()
+                _segment_t = 0.
 
             _start_t = perf_counter()
-            for batch_idx, model_inputs in enumerate(pbar):
-                if "IndexHints" in cfg.task.train.dataset_cls and cfg.task.get('hide_index_hints', False):
-                    model_inputs['labels'] = torch.where(
-                        torch.logical_and(model_inputs['labels'] >= id_index_hint_begin, 
-                                          model_inputs['labels'] <= id_index_hint_end),
-                        -100,
-                        model_inputs['labels']
-                    )
-                with torch.set_grad_enabled(phase == 'train'):
-                    with ctx:
-                        model_output = model(**model_inputs)
-                        loss = model_output.loss
-                    if phase == 'train' and epoch > 0:
-                        if scaler is not None:
-                            scaler.scale(loss).backward()
-                            if grad_clip > 0.:
-                                scaler.unscale_(optimizer)
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-                            scaler.step(optimizer)
-                            scaler.update()
-                        else:
-                            loss.backward()
-                            if grad_clip > 0.:
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-                            optimizer.step()
-                        optimizer.zero_grad(set_to_none=True)
-                        scheduler.step()
-                        counter_training += 1
-                with torch.no_grad():
-                    batchsize = len(model_inputs['input_ids'])
-                    loss_sum += loss.float() * batchsize
-                    # if not use_wandb and batch_idx == 0:
-                        # logits = model_output.logits
-                        # pred = torch.argmax(logits, dim=-1)
-                        # d_positions = getattr(cfg.model, 'd_positions', None)
-                        # print(phase.upper())
-                        # if d_positions is None:
-                        #     print("Input     :", model_inputs['input_ids'][0].cpu().numpy() - id_0)
-                        #     if 'position_ids' in model_inputs:
-                        #         print("Position  :", model_inputs['position_ids'][0].cpu().numpy())
-                        #     if model_name in DECODER_BASED:
-                        #         lab = model_inputs['labels'][0, 1:]
-                        #         print("Prediction:", pred[0, :-1][lab != -100].cpu().numpy() - id_0)
-                        #     else:
-                        #         lab = model_inputs['labels'][0]
-                        #         print("Prediction:", pred[0][lab != -100].cpu().numpy() - id_0)
-                        #     print("Label     :", lab[lab != -100].cpu().numpy() - id_0)
-                        # elif not cfg.task.train.dataset_cls.startswith("MineSweeper"):
-                        #     print("Input     :", model_inputs['input_ids'][0].cpu().numpy() - id_0)
-                        #     if 'position_ids' in model_inputs:
-                        #         print("Position  :", model_inputs['position_ids'][:, 0].cpu().numpy())
-                        #     if model_name in DECODER_BASED:
-                        #         lab = model_inputs['labels'][0, 1:]
-                        #         print("Prediction:", pred[0, :-1][lab != -100].cpu().numpy() - id_0)
-                        #     else:
-                        #         lab = model_inputs['labels'][0]
-                        #         print("Prediction:", pred[0][lab != -100].cpu().numpy() - id_0)
-                        #     print("Label     :", lab[lab != -100].cpu().numpy() - id_0)
-                        # else: # e.g. Minesweeper with coupling
-                        #     assert model_name in DECODER_BASED
-                        #     print_2D(model_inputs, pred, id_0)
-                    if epoch % calc_acc_every_epochs == 0 or epoch == n_epochs:
-                        logits = model_output.logits
-                        pred = torch.argmax(logits, dim=-1)
-                        tokenwise_correct, num_tokens = get_tokenwise_accuracy(cfg, pred, model_inputs['labels'], tokenizer.pad_token_id, division=False)
-                        instancewise_correct, _ = get_instancewise_accuracy(cfg, pred, model_inputs['labels'], tokenizer.pad_token_id, division=False)
-                        tokenwise_correct_sum += tokenwise_correct
-                        num_tokens_sum += num_tokens
-                        instancewise_correct_sum += instancewise_correct
-                        pbar.set_description(f"[{counter_training}/{n_steps}] {phase.upper()} | LR:{scheduler.get_last_lr()[0]:.3g} | Loss:{loss:.3f} | "
-                                            f"TokenAcc:{tokenwise_correct/num_tokens:.3f} | InstAcc:{instancewise_correct/batchsize:.3f}") 
-                    else:
-                        pbar.set_description(f"[{counter_training}/{n_steps}] {phase.upper()} | LR:{scheduler.get_last_lr()[0]:.3g} | Loss:{loss:.3f}")        
-            epoch_time = perf_counter() - _start_t
-            
-            # Logging at the end of epoch
-            loss_avg = loss_sum.item()/len(dataset[phase])
-            losses[phase].append(loss_avg)
-            if epoch % calc_acc_every_epochs == 0:
-                tokenwise_accuracy_avg = (tokenwise_correct_sum/num_tokens_sum).item()
-                instancewise_accuracy_avg = instancewise_correct_sum.item()/len(dataset[phase])
-                tokenwise_accuracies[phase].append(tokenwise_accuracy_avg)
-                instancewise_accuracies[phase].append(instancewise_accuracy_avg)
-                # if getattr(cfg.model, 'd_positions', None) is None:
-                #     _, _, _, example = print_example(cfg, ctx, epoch, phase, tokenizer, dataset, model, verbose=False)
-                #     print(example)
-            
-            # log checkpoint data
-            print(f"({epoch=}): logging data for {phase}... {loss_avg:.3g} | {tokenwise_accuracy_avg:.3g} | {instancewise_accuracy_avg:.3g} | {epoch_time:.3g}")
-            checkpoint_data['losses'][phase].append(loss_avg)
-            checkpoint_data['tokenwise'][phase].append(tokenwise_accuracy_avg)
-            checkpoint_data['instancewise'][phase].append(instancewise_accuracy_avg)
-            checkpoint_data['times'][phase].append(epoch_time)
-
-            # W&B
-            if use_wandb:
-                log_data = {'loss': loss_avg}
-                if epoch % calc_acc_every_epochs == 0:
-                    log_data['tokenwise_accuracy'] = tokenwise_accuracy_avg
-                    log_data['instancewise_accuracy'] = instancewise_accuracy_avg
-                    # if getattr(cfg.model, 'd_positions', None) is None: 
-                    #     log_data['example'] = example
-                log_data = {f"{phase}/{k}": v for k, v in log_data.items()}
-                if phase == 'train':
-                    log_data['misc/learning_rate'] = scheduler.get_last_lr()[0]
-                run.log(log_data, step=counter_training)
-            # Print result of epoch
-            if epoch % calc_acc_every_epochs == 0:
-                print(f"Epoch {epoch}/{n_epochs} {phase.upper()} Loss {loss_avg:.6f} "
-                      f"TokenAcc {tokenwise_accuracy_avg:.6f} "
-                      f"InstAcc {instancewise_accuracy_avg:.6f}")
-            else:
-                print(f"Epoch {epoch}/{n_epochs} {phase.upper()} Loss {loss_avg:.6f} ")
+            for batch_idx, model_inputs in enumerate(pbar, start=skip):
+                run_batch(phase, model_inputs, train_metrics, calc_acc=calc_acc or bool(eval_every_steps))
+                # (lazy) training sets may be far longer than n_steps batches
+                last_batch = counter_training >= n_steps or batch_idx + 1 == len(loader[phase])
+                eval_step = eval_every_steps and (counter_training % eval_every_steps == 0 or counter_training >= n_steps)
+                if (batch_idx + 1) % log_every_steps == 0 or last_batch or eval_step:
+                    log_running_metrics(phase, pbar, train_metrics, calc_acc=calc_acc or bool(eval_every_steps))
+                if eval_step:
+                    _segment_t += perf_counter() - _start_t
+                    train_time += perf_counter() - _start_t
+                    log_phase(epoch, phase, train_metrics.summary(), _segment_t, log_acc=True)
+                    evaluate(epoch, log_acc=True)
+                    train_metrics = RunningMetrics()
+                    _segment_t = 0.
+                    _start_t = perf_counter()
+                if checkpoint_every_steps and counter_training % checkpoint_every_steps == 0:
+                    _segment_t += perf_counter() - _start_t
+                    train_time += perf_counter() - _start_t
+                    save_training_state(epoch, batch_idx, epoch_state)
+                    _start_t = perf_counter()
+                if counter_training >= n_steps: break
+            _segment_t += perf_counter() - _start_t
+            train_time += perf_counter() - _start_t
+            if not eval_every_steps:
+                log_phase(epoch, phase, train_metrics.summary(), _segment_t, log_acc=epoch % calc_acc_every_epochs == 0)
 
-            # Plot results                        
-            if phase == phases[-1] and epoch % calc_acc_every_epochs == 0:
-                fig, ax = plt.subplots(1,1) 
-                for p in phases:
-                    ax.semilogy(torch.arange(1,len(losses[p])+1).numpy()*calc_acc_every_epochs, 
-                            losses[p], 
-                            label=p+f" (Final:{losses[p][-1]:.3g} | Min:{min(losses[p]):.3g})", 
-                            marker='.')
-                ax.legend()
-                ax.set_title("Loss")
-                fig.savefig(os.path.join(logging_path, f"loss.pdf"))
-                plt.close(fig)
-                fig, ax = plt.subplots(1,1)
-                for p in phases:
-                    ax.plot(torch.arange(1,len(tokenwise_accuracies[p])+1).numpy()*calc_acc_every_epochs, 
-                            tokenwise_accuracies[p], 
-                            label=p+f" (Final:{tokenwise_accuracies[p][-1]:.3g} | Max:{max(tokenwise_accuracies[p]):.3g})", 
-                            marker='.')
-                ax.legend()
-                ax.set_title("Tokenwise Accuracy")
-                fig.savefig(os.path.join(logging_path, f"tokenwise_accuracy.pdf"))
-                plt.close(fig)
-                fig, ax = plt.subplots(1,1)
-                for p in phases:
-                    ax.plot(torch.arange(1,len(instancewise_accuracies[p])+1).numpy()*calc_acc_every_epochs,
-                            instancewise_accuracies[p],
-                            label=p+f" (Final:{instancewise_accuracies[p][-1]:.3g} | Max:{max(instancewise_accuracies[p]):.3g})",
-                            marker='.')
-                ax.legend()
-                ax.set_title("Instance-wise Accuracy")
-                fig.savefig(os.path.join(logging_path, f"instancewise_accuracy.pdf"))
-                plt.close(fig)
-            # Save Best Model (in terms of min val_long loss)
-            if save and phase == 'val_long' and min_val_loss > losses['val_long'][-1]:
-                min_val_loss = losses['val_long'][-1]
-                torch.save(model.state_dict(), os.path.join(logging_path, f"best_{model_name}.pt"))
-        
         print()
+
+    # Save last model
+    if save:
+        checkpoint_writer.save(model.state_dict(), os.path.join(logging_path, f"last_{model_name}.pt"))
+    checkpoint_writer.close()
+    log_checkpoint_writes()
+    if checkpoint_writes:
+        checkpoint_blocking_sec = sum(write['blocking_sec'] for write in checkpoint_writes)
+        checkpoint_write_sec = max(write['write_sec'] for write in checkpoint_writes)
+        print(f"{len(checkpoint_writes)} checkpoint writes: {checkpoint_blocking_sec:.3g}s blocking training in total, "
+              f"each written in at most {checkpoint_write_sec:.3g}s")
+    if eval_every_steps and (not eval_steps or eval_steps[-1] != counter_training):
+        # (the training epochs ended before n_steps)
+        log_phase(epoch, 'train', train_metrics.summary(), _segment_t, log_acc=True)
+        evaluate(epoch, log_acc=True)
     
     checkpoints_details_f = os.path.join(logging_path, f"epoch_details.txt")
     n_checkpoints = len(checkpoint_data['losses']['train'])
     with open(checkpoints_details_f, 'w') as f:
         
         print(f"{n_steps} steps total, {n_checkpoints} checkpoints logged", file=f)
+        print(f"wall-clock train/eval: {train_time:.3g}s/{eval_time:.3g}s (eval at steps {eval_steps})", file=f)
+        if any(eval_quick):
+            print(f"quick evals ({eval_batches} batches per eval set) at checkpoints {[i+1 for i, q in enumerate(eval_quick) if q]}", file=f)
+        if checkpoint_writes:
+            print(f"checkpoint writes: {len(checkpoint_writes)}, blocking {checkpoint_blocking_sec:.3g}s in total, "
+                  f"max write latency {checkpoint_write_sec:.3g}s", file=f)
         print("==========", file=f)
 
         print(f"train/eval times (checkpoint#/train/val/val_long)\n", file=f)
@@ -397,15 +647,19 @@ def run(args):
     
     # Save config
     dict_cfg['best_val_long_loss'] = min_val_loss
+    dict_cfg['train_time'] = train_time
+    dict_cfg['eval_time'] = eval_time
+    dict_cfg['checkpoint_writes'] = checkpoint_writes
     dict_cfg['loss'] = losses
     dict_cfg['tokenwise_accuracy'] = tokenwise_accuracies
     dict_cfg['instancewise_accuracy'] = instancewise_accuracies
+    if any(eval_quick):
+        dict_cfg['quick_eval_steps'] = [s for s, q in zip(eval_steps, eval_quick) if q]
+        dict_cfg['quick_loss'] = quick_losses
+        dict_cfg['quick_tokenwise_accuracy'] = quick_tokenwise_accuracies
+        dict_cfg['quick_instancewise_accuracy'] = quick_instancewise_accuracies
     with open(os.path.join(logging_path, 'cfg.json'), 'w') as f:
         json.dump(dict_cfg, f, indent=2)
-    
-    # Save last model
-    if save:
-        torch.save(model.state_dict(), os.path.join(logging_path, f"last_{model_name}.pt"))
 
 if __name__ == '__main__':
     
@@ -2,6 +2,8 @@ import time
 import torch
 
 from src.model import DECODER_BASED, ENCODER_DECODER_BASED, CustomDecoderOnlyT5
+from src.tokenization import tokenize_for_decoder
+from src.evaluate.generation import GREEDY_DECODING_MODELS, generate_for_batch
 
 
 def print_training_update(phase,
@@ -31,27 +33,38 @@ def print_example(cfg, ctx, epoch, phase, tokenizer, dataset, model:CustomDecode
         input_positions, label_positions = data[2:]
     label_str = label_str.replace(" ", '')
 
-    if cfg.model.model_name in DECODER_BASED and cfg.task.eos:
+    if cfg.model.model_name in GREEDY_DECODING_MODELS:
+        # KV-cached greedy decoding with the (coupled) positions of the answer tokens
+        batch = tokenize_for_decoder(
+            tokenizer, [data[0]], [data[1]],
+            *(([input_positions], [label_positions]) if input_positions is not None else ()),
+            device=device
+        )
+        with ctx:
+            prompt_ids, generated, _ = generate_for_batch(cfg, model, batch, tokenizer)
+        model_output = torch.cat([prompt_ids, generated], dim=1)
+    elif cfg.model.model_name in DECODER_BASED and cfg.task.eos:
         input_ids = torch.LongTensor([enc.ids[:-1] for enc in tokenizer.encode_batch([f"{input_str}="])]).to(device)  # delete [EOS]
     elif cfg.model.model_name in ENCODER_DECODER_BASED+DECODER_BASED:
         input_ids = torch.LongTensor([enc.ids for enc in tokenizer.encode_batch([input_str])]).to(device)
     else:
         raise ValueError(f"model_name: {cfg.model.model_name}")
     
-    max_length = 250
-    position_ids = None
-    if input_positions is not None:
-        position_ids = [0] + input_positions + label_positions
-        position_ids += [0] * (max_length - len(position_ids))
-        position_ids = torch.LongTensor(position_ids).to(device)
+    if cfg.model.model_name not in GREEDY_DECODING_MODELS:
+        max_length = 250
+        position_ids = None
+        if input_positions is not None:
+            position_ids = [0, *input_positions, *label_positions]
+            position_ids += [0] * (max_length - len(position_ids))
+            position_ids = torch.LongTensor(position_ids).to(device)
 
-    model_input = {
-        'input_ids': input_ids,
-        'position_ids': position_ids,
-        'max_length': max_length
-    }
-    with ctx:
-        model_output = model.generate(**model_input)
+        model_input = {
+            'input_ids': input_ids,
+            'position_ids': position_ids,
+            'max_length': max_length
+        }
+        with ctx:
+            model_output = model.generate(**model_input)
     decoded = tokenizer.decode_batch(model_output.cpu().tolist())[0]
     decoded = decoded.replace(' ', '')
 
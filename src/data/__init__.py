@@ -1 +1 @@
-from .arithmetic_dataset import build_dataset, build_loader, build_auxiliary_dataset, build_auxiliary_loader, build_dataset_varied
\ No newline at end of file
+from .arithmetic_dataset import build_dataset, build_loader, build_subset_loader, build_auxiliary_dataset, build_auxiliary_loader, build_dataset_varied
\ No newline at end of file
@@ -2,7 +2,9 @@ import torch
 import numpy as np
 from tqdm import tqdm, trange
 from src.tokenization import SpecialToken
-from src.data.common import ArithmeticDataset
+from src.data.common import ArithmeticDataset, GENERATION_CHUNK_SIZE, \
+    sample_digit_matrix, count_digits, digit_matrix_to_chars, char_matrix_to_strings, \
+    space_strings, draw_starts, segment_positions, operand_segments, split_lengths, split_positions
 
 
 ################ Helper Functions ################
@@ -102,6 +104,20 @@ def generate_scratchpad_multiple_addition(numbers: list, reversed_num=True, reve
     return scratchpad
 
 
+def add_digit_matrices(a, b):
+    # digit-wise addition of little-endian digit matrices with vectorized carry propagation:
+    # a carry enters column i iff the nearest column j < i whose digit sum is not 9 has a digit sum >= 10
+    n, width = a.shape
+    digit_sum = np.zeros((n, width+1), dtype=np.int8)
+    digit_sum[:, :width] = a + b
+    cols = np.arange(width+1, dtype=np.int16)
+    last_not_nine = np.maximum.accumulate(np.where(digit_sum != 9, cols, -1), axis=1)
+    prev = np.concatenate([np.full((n, 1), -1, dtype=np.int16), last_not_nine[:, :-1]], axis=1)
+    carry = (prev >= 0) & (np.take_along_axis(digit_sum, np.maximum(prev, 0), axis=1) >= 10)
+    result = digit_sum + carry
+    return result - 10 * (result >= 10)
+
+
 ################ END of Helper Functions ################
 
 #########################################################
@@ -120,53 +136,50 @@ class AdditionDataset(ArithmeticDataset):
             max_n_digit_A=None,
             min_n_digit_B=None,
             max_n_digit_B=None,
+            lazy=False,
+            seed_data=None,
+            phase=None,
             **kwargs
         ):
         super().__init__()
         self.reverse_input = reverse_input
         self.reverse_output = reverse_output
+        self.padding = padding
+        self.pad_token = pad_token
+        if min_n_digit_A is None or \
+            max_n_digit_A is None or \
+            min_n_digit_B is None or \
+            max_n_digit_B is None:
+            min_n_digit_A = min_n_digit_B = min_n_digits
+            max_n_digit_A = max_n_digit_B = max_n_digits
+        self.n_digits_range = [(min_n_digit_A, max_n_digit_A), (min_n_digit_B, max_n_digit_B)]
         self.inputs = []
         self.labels = []
-        self.pad_token = pad_token
-        for _ in trange(n_data):
-            if len(self.inputs) >= n_data: break
-            numbers = []
-            # uniform sampling of n_digits of two numbers
-            if min_n_digit_A is None or \
-                max_n_digit_A is None or \
-                min_n_digit_B is None or \
-                max_n_digit_B is None:
-                n_digits_arr = torch.randint(low=min_n_digits, high=max_n_digits+1, size=(2, ))
-            else:
-                n_digits_arr = torch.tensor([
-                    torch.randint(low=min_n_digit_A, high=max_n_digit_A+1, size=(1,)).item(),
-                    torch.randint(low=min_n_digit_B, high=max_n_digit_B+1, size=(1,)).item(),
-                ])
-            for i in range(2):
-                n_digits = n_digits_arr[i].item()
-                # uniform sampling of a number
-                if n_digits == 1:
-                    num = torch.randint(0, 10, size=(1,)).item()
-                else:
-                    num_arr = [torch.randint(1, 10, size=(1,)).item()] + torch.randint(0, 10, size=(n_digits-1,)).tolist()
-                    num = int(''.join(map(str, num_arr)))
-                numbers.append(int(num))
-            a, b = numbers
-            result = a + b
-            max_len = max(len(str(a)),len(str(b)))
-            overflow = max_len + 1
-
-            if padding:
-                _inputs = [f"{'P'*(max_len-len(str(c)))}{c}" for c in numbers]
-                _labels = f"{'P'*(overflow-len(str(result)))}{result}"
-            else:
-                _inputs = list(map(str, numbers))
-                _labels = str(result)
-            if reverse_input: _inputs = [x[::-1] for x in _inputs]
-            if reverse_output: _labels = _labels[::-1]
-            _inputs = "+".join(_inputs)
-            self.inputs.append(_inputs)
-            self.labels.append(_labels)
+        if lazy:
+            self.set_lazy(n_data, seed_data, phase)
+            return
+        rng = np.random.default_rng(torch.randint(2**62, size=(1,)).item())
+        for i in trange(0, n_data, GENERATION_CHUNK_SIZE):
+            _inputs, _labels = self.generate_batch(min(GENERATION_CHUNK_SIZE, n_data-i), rng)
+            self.inputs.extend(_inputs)
+            self.labels.extend(_labels)
+
+    def generate_batch(self, n, rng):
+        # uniform sampling of n_digits of two numbers, then of the numbers themselves
+        n_digits_arr = [rng.integers(low, high+1, size=n) for low, high in self.n_digits_range]
+        width = max(high for _, high in self.n_digits_range)
+        a, b = [sample_digit_matrix(n_digits, width, rng) for n_digits in n_digits_arr]
+        result = add_digit_matrices(a, b)
+        max_len = np.maximum(*n_digits_arr)
+        overflow = max_len + 1
+
+        a, b = [digit_matrix_to_chars(c, n_digits, max_len if self.padding else 0, self.reverse_input)
+                for c, n_digits in zip((a, b), n_digits_arr)]
+        result = digit_matrix_to_chars(result, count_digits(result), overflow if self.padding else 0, self.reverse_output)
+        plus = np.full((n, 1), ord('+'), dtype=np.uint8)
+        _inputs = char_matrix_to_strings(np.concatenate([a, plus, b], axis=1))
+        _labels = char_matrix_to_strings(result)
+        return _inputs, _labels
 
 
 #########################################################
@@ -192,48 +205,44 @@ class AdditionDatasetWithCoupledPositions(AdditionDataset):
         super().__init__(n_data, min_n_digits, max_n_digits,
             reverse_input, reverse_output, padding, pad_token,
             **kwargs)
-        
-        # print(f"on init: inputs= {self.inputs}, labels={self.labels}")
-
-    def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
-        a, b = inputs.split('+')
+        if not self.lazy:
+            # white spaces / pad tokens and the lengths the positions depend on are prepared once
+            self.inputs, self.labels, self.operand_lengths, self.label_lengths = self.prepare(self.inputs, self.labels)
+
+    def prepare(self, inputs, labels):
+        operand_lengths = split_lengths(inputs, '+').astype(np.int16)
+        label_lengths = np.array(list(map(len, labels)), dtype=np.int16)
+        # Put white spaces; converts 'P' --> pad_token
+        inputs, labels = space_strings(inputs, self.pad_token), space_strings(labels, self.pad_token)
+        return inputs, labels, operand_lengths, label_lengths
+
+    def __getitems__(self, indices):
+        if self.lazy:
+            inputs, labels, operand_lengths, label_lengths = self.prepare(*self.get_raw_batch(indices))
+        else:
+            inputs, labels = self.get_raw_batch(indices)
+            operand_lengths, label_lengths = self.operand_lengths[indices], self.label_lengths[indices]
+        operand_lengths, label_lengths = operand_lengths.astype(np.int64), label_lengths.astype(np.int64)
+        input_lengths = operand_lengths.sum(axis=1) + 1
         if self.vanilla:
-            start = 1 if not self.randomize else torch.randint(1, self.max_position-len(inputs)-len(labels)+1, size=(1,)).item()
-            positions = list(range(start, start + len(inputs) + len(labels) + 1))
-            input_positions, label_positions = positions[:len(inputs)], positions[len(inputs):]
+            starts = draw_starts(1, self.max_position-input_lengths-label_lengths+1, self.randomize)
+            segments = [(starts, input_lengths+label_lengths+1, 1)]
         else:
             # modified: least significant digit has least position ID
-            start = 1 if not self.randomize else torch.randint(1, self.max_position-len(labels)+(1 if self.reverse_output else 0), size=(1,)).item()
-            # print(f"Addition.__get__item: {start=}, inps: {inputs}, labels: {labels}")
-            plus_position = start
-            a_positions = list(range(start+1, start+1+len(a)))
-            b_positions = list(range(start+1, start+1+len(b)))
-
-            # print(f"initial a and b_positions before reversecheck: {a_positions=}, {b_positions=}")
-            if not self.reverse_input:
-                a_positions = a_positions[::-1]
-                b_positions = b_positions[::-1]
-            input_positions = a_positions + [plus_position] + b_positions
-
-            # print(f"input_positions after reversecheck: {input_positions=}")
-
-            ans_positions = list(range(start+1, start+1+len(labels)))
+            starts = draw_starts(1, self.max_position-label_lengths+(1 if self.reverse_output else 0), self.randomize)
+            segments = operand_segments(starts, operand_lengths, self.reverse_input)
             if self.reverse_output:
-                eq_position = start
+                segments.append((starts, label_lengths+1, 1))  # '=' at start
             else:
-                ans_positions = ans_positions[::-1]
-                eq_position = start+len(labels)+1
-            label_positions = [eq_position] + ans_positions
-            
-        # Put white spaces
-        inputs = " ".join(inputs).replace('P', str(self.pad_token))
-        labels = " ".join(labels).replace('P', str(self.pad_token))
-
-        print(f"(debug) {inputs=} {labels=}")
+                segments.append((starts+label_lengths+1, label_lengths+1, -1))
+        positions, row_lengths = segment_positions(len(indices), segments)
+        input_positions, label_positions = split_positions(positions, row_lengths, input_lengths)
+        batch = list(zip(inputs, labels, input_positions, label_positions))
+        self.log_samples(batch)
+        return batch
 
-        return inputs, labels, input_positions, label_positions
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
     
 
 #########################################################
@@ -260,8 +269,7 @@ class AdditionDatasetWithIndexHints(AdditionDataset):
             hard_carry, **kwargs)
         
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         a, b = inputs.split('+')
         a = 'P' + a
         b = 'P' + b
@@ -414,27 +422,36 @@ class MultipleAdditionDatasetWithCoupledPositions(MultipleAdditionDataset):
             **kwargs
         )
 
-    def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
-        numbers = inputs.split('+')
-        max_len = max(map(len, numbers + [labels]))
+    def __getitems__(self, indices):
+        inputs_batch, labels_batch = self.get_raw_batch(indices)
+        input_lengths = np.array(list(map(len, inputs_batch)))
+        label_lengths = np.array(list(map(len, labels_batch)))
+        operand_lengths = split_lengths(inputs_batch, '+')
+        max_len = np.maximum(operand_lengths.max(axis=1), label_lengths)
         start_ = 1
         if self.vanilla:
-            start = 1 if not self.randomize else torch.randint(1, self.max_position-len(inputs)-len(labels)+1, size=(1,)).item()
-            positions = list(range(start, start + len(inputs) + len(labels) + 1))
-            input_positions, label_positions = positions[:len(inputs)], positions[len(inputs):]
+            starts = draw_starts(1, self.max_position-input_lengths-label_lengths+1, self.randomize)
+            segments = [(starts, input_lengths+label_lengths+1, 1)]
         else:
             # default
-            start = start_ if not self.randomize else torch.randint(1, self.max_position-max_len+1, size=(1,)).item()
-            input_positions = sum((list(range(start, start+len(a)+1))[::1 if self.reverse_input else -1] for a in numbers), start=[])
-            input_positions = input_positions[1:] if self.reverse_input else input_positions[:-1]
-            label_positions = list(range(start, start+len(labels)+1))[::1 if self.reverse_output else -1]
-            if not self.reverse_output: label_positions = label_positions[-1:] + label_positions[:-1]
+            starts = draw_starts(start_, self.max_position-max_len+1, self.randomize)
+            segments = operand_segments(starts, operand_lengths, self.reverse_input)
+            segments.append((starts, 1, 0))  # '='
+            if self.reverse_output:
+                segments.append((starts+1, label_lengths, 1))
+            else:
+                segments.append((starts+label_lengths, label_lengths, -1))
+        positions, row_lengths = segment_positions(len(indices), segments)
+        input_positions, label_positions = split_positions(positions, row_lengths, input_lengths)
         # Put white spaces
-        inputs = " ".join(inputs).replace('P', str(self.pad_token))
-        labels = " ".join(labels).replace('P', str(self.pad_token))
-        return inputs, labels, input_positions, label_positions
+        inputs_batch = [" ".join(inputs).replace('P', str(self.pad_token)) for inputs in inputs_batch]
+        labels_batch = [" ".join(labels).replace('P', str(self.pad_token)) for labels in labels_batch]
+        batch = list(zip(inputs_batch, labels_batch, input_positions, label_positions))
+        self.log_samples(batch)
+        return batch
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
 
 
 #########################################################
@@ -520,8 +537,7 @@ class MultipleAdditionScratchPadDataset(ArithmeticDataset):
             self.labels.append(result)
 
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         # Put white spaces
         inputs = " ".join(inputs).replace('P', str(self.pad_token))  # Converts 'P' --> pad_token
         labels = " ".join(labels).replace('P', str(self.pad_token))  # Converts 'P' --> pad_token
@@ -576,8 +592,7 @@ class MultipleAdditionScratchPadDatasetWithCoupledPositions(MultipleAdditionScra
             **kwargs)
 
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         inp_numbers = inputs.split('+')
         lab_numbers = labels.split('>')
         n_op = len(inp_numbers)
@@ -683,22 +698,30 @@ class CarryDatasetWithCoupledPositions(CarryDataset):
         super().__init__(n_data, min_n_digits, max_n_digits,
             reverse_output, commutative, padding, pad_token, **kwargs)
 
-    def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
-        a, b = inputs.split('+')
-        max_len = max(len(a),len(b))
-        start = 1 if not self.randomize else torch.randint(1, self.max_position-max_len, size=(1,)).item()
-        end = start + max_len + 1
-        input_positions = list(range(end-len(a), end+1)) + list(range(end-len(b), end+1))
-        label_positions = list(range(end-len(labels), end))
+    def __getitems__(self, indices):
+        inputs_batch, labels_batch = self.get_raw_batch(indices)
+        label_lengths = np.array(list(map(len, labels_batch)))
+        operand_lengths = split_lengths(inputs_batch, '+')
+        max_len = operand_lengths.max(axis=1)
+        starts = draw_starts(1, self.max_position-max_len, self.randomize)
+        ends = starts + max_len + 1
+        segments = [(ends-operand_lengths[:, k], operand_lengths[:, k]+1, 1) for k in range(2)]
         if self.reverse_output:
-            labels = labels[::-1]
-            label_positions = label_positions[::-1]
+            labels_batch = [labels[::-1] for labels in labels_batch]
+            segments.append((ends-1, label_lengths, -1))
+        else:
+            segments.append((ends-label_lengths, label_lengths, 1))
+        positions, row_lengths = segment_positions(len(indices), segments)
+        input_positions, label_positions = split_positions(positions, row_lengths, operand_lengths.sum(axis=1)+2)
         # Put white spaces
-        inputs = " ".join(inputs).replace('P', str(self.pad_token))
-        labels = " ".join(labels).replace('P', str(self.pad_token))
-        return inputs, labels, input_positions, label_positions
+        inputs_batch = [" ".join(inputs).replace('P', str(self.pad_token)) for inputs in inputs_batch]
+        labels_batch = [" ".join(labels).replace('P', str(self.pad_token)) for labels in labels_batch]
+        batch = list(zip(inputs_batch, labels_batch, input_positions, label_positions))
+        self.log_samples(batch)
+        return batch
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
         
 
 ################################################################
@@ -1,13 +1,19 @@
 import os
 from functools import partial
+import numpy as np
+import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from dotmap import DotMap
 from omegaconf import OmegaConf
 
-from src.tokenization import tokenize_for_decoder, tokenize_for_encoder_decoder
+from src.tokenization import tokenize_for_decoder, tokenize_for_encoder_decoder, pad_for_decoder, pack_for_decoder
 from src.model import DECODER_BASED, ENCODER_DECODER_BASED
+from src.model.build_model import CUSTOM_T5_DECODER_ONLY
 from src.data.common import OPERATORS, Operation
+from src.data.cache import PretokenizedDataset, get_cache_path, is_cacheable, load_cache, write_cache
+from src.data.sampler import LengthBucketSampler, get_token_lengths, padding_efficiency
+from src.data.prefetch import DeviceLoader, get_num_workers
 
 # The actual implementation of datasets are here!
 from src.data.addition import *
@@ -17,6 +23,13 @@ from src.data.parity import *
 from src.data.minesweeper import *
 from src.data.varied_arithmetic import VariedDatasetWithCoupledPositions
 
+def set_debug_sampling(cfg, dataset):
+    # `debug_samples: N` logs the first N examples every phase serves per epoch
+    for phase in dataset:
+        if cfg.get('debug_samples', 0) and hasattr(dataset[phase], 'set_debug_sampling'):
+            dataset[phase].set_debug_sampling(cfg.debug_samples)
+
+
 def build_dataset_varied(cfg):
     task_cfg = OmegaConf.to_container(cfg.task)
 
@@ -53,10 +66,13 @@ def build_dataset_varied(cfg):
                 input, label = item[:2]
                 f_i.write(input+"\n")
                 f_o.write(label+"\n")
+    set_debug_sampling(cfg, dataset)
     return dataset
 
 ## Build Dataset (train / val / val_long)
-def build_dataset(cfg, verbose=True):
+## With `dataset_cache: True` (and a tokenizer for a decoder-only model), phases with
+## deterministic position IDs are tokenized once and memory-mapped from ./dataset/cache afterwards.
+def build_dataset(cfg, verbose=True, tokenizer=None):
     task_cfg = OmegaConf.to_container(cfg.task)
     symbol = task_cfg['symbol']
     n_input = OPERATORS[symbol]['n_input']
@@ -73,18 +89,37 @@ def build_dataset(cfg, verbose=True):
     
     print(f"[build_dataset]: phases = {phases}")
     print(f"[build_dataset]: common_task_cfg = {common_task_cfg}")
+
+    use_cache = cfg.get('dataset_cache', False) and tokenizer is not None and cfg.model.model_name in DECODER_BASED
+    seed_data = torch.initial_seed()
     
     for phase in phases:
         if phase not in task_cfg:
             continue
         if verbose: print(f"{phase}...")
+        if use_cache:
+            cache_path = get_cache_path(cfg, phase, seed_data)
+            dataset[phase] = load_cache(cache_path)
+            if dataset[phase] is not None:
+                if verbose: print(f"[build_dataset] phase={phase}, loaded from {cache_path}")
+                continue
         print(f"[build_dataset] phase={phase}, eval'ing: {task_cfg[phase]['dataset_cls']}")
         dataset_cls = eval(task_cfg[phase].pop('dataset_cls'))
+        lazy_kwargs = {}
+        if common_task_cfg.get('lazy', False):
+            # examples are regenerated from (seed_data, phase, index) on access
+            if not hasattr(dataset_cls, 'generate_batch'):
+                raise NotImplementedError(f"{dataset_cls.__name__} does not support lazy generation")
+            lazy_kwargs = dict(seed_data=cfg.seed_data, phase=phase)
         dataset[phase] = dataset_cls(
             operation=operation, 
             **task_cfg[phase],
-            **common_task_cfg
+            **common_task_cfg,
+            **lazy_kwargs
         )
+        if use_cache and is_cacheable(dataset[phase]):
+            rng_state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state()}
+            write_cache(cache_path, dataset[phase], tokenizer, rng_state, verbose=verbose)
     if verbose: print()
     
     ## Store datasets ##
@@ -92,6 +127,7 @@ def build_dataset(cfg, verbose=True):
     if not os.path.exists(data_path): 
         os.makedirs(data_path)
     for phase in dataset.keys():
+        if isinstance(dataset[phase], PretokenizedDataset): continue
         pbar = tqdm(dataset[phase], disable=not verbose)
         with open(f"{data_path}/{phase}_input.txt", "w") as f_i, \
             open(f"{data_path}/{phase}_label.txt", "w") as f_o:
@@ -100,19 +136,61 @@ def build_dataset(cfg, verbose=True):
                 input, label = item[:2]
                 f_i.write(input+"\n")
                 f_o.write(label+"\n")
+    set_debug_sampling(cfg, dataset)
     return dataset
 
 
-def tokenize_fn(x, cfg, tokenizer, device, arr_type):
+def tokenize_fn(x, cfg, tokenizer, device, arr_type, pack_length=None):
     if cfg.model.model_name in ENCODER_DECODER_BASED:
         fn = tokenize_for_encoder_decoder
     elif cfg.model.model_name in DECODER_BASED:
         fn = tokenize_for_decoder
     else:
         raise ValueError(f"model_name: {cfg.model.model_name}")
+    if pack_length is not None:
+        out = fn(tokenizer, *zip(*x), arr_type='numpy')
+        return pack_for_decoder(tokenizer, out, pack_length, device=device, arr_type=arr_type)
     return fn(tokenizer, *zip(*x), device=device, arr_type=arr_type)
+
+
+def pad_fn(x, cfg, tokenizer, device, arr_type, pack_length=None):
+    if pack_length is not None:
+        out = pad_for_decoder(tokenizer, *zip(*x), arr_type='numpy')
+        return pack_for_decoder(tokenizer, out, pack_length, device=device, arr_type=arr_type)
+    return pad_for_decoder(tokenizer, *zip(*x), device=device, arr_type=arr_type)
+
+
+def get_pack_length(cfg, phase):
+    # `training.packing: True`: training batches are packed into rows of `pack_length` tokens
+    if not cfg.training.get('packing', False) or phase != 'train':
+        return None
+    if cfg.model.model_name != CUSTOM_T5_DECODER_ONLY:
+        raise ValueError(f"packing is only supported for {CUSTOM_T5_DECODER_ONLY} (model_name: {cfg.model.model_name})")
+    return cfg.training.pack_length
     
 
+def build_bucket_sampler(cfg, dataset, phase, batch_size, n_device=1, verbose=True):
+    # `training.bucketing: True`: batches of examples of similar length (src/data/sampler.py)
+    lengths = get_token_lengths(dataset)
+    if lengths is None:
+        if verbose: print(f"[build_loader] phase={phase}: example lengths are unknown ({type(dataset).__name__}), no bucketing")
+        return None
+    max_tokens = cfg.training.get('max_tokens_per_batch', None)
+    sampler = LengthBucketSampler(
+        lengths,
+        batch_size=None if max_tokens else batch_size,
+        max_tokens=max_tokens // n_device if max_tokens else None,
+        shuffle=(phase == 'train'),
+        bucket_size=cfg.training.get('bucket_size', 100),
+    )
+    if verbose:
+        n_batches = len(sampler)
+        random_batches = np.array_split(np.random.default_rng(0).permutation(len(lengths)), n_batches)
+        print(f"[build_loader] phase={phase}: {n_batches} length-bucketed batches, "
+              f"padding efficiency {sampler.padding_efficiency():.3f} (random batches: {padding_efficiency(lengths, random_batches):.3f})")
+    return sampler
+
+
 def build_loader(
         cfg, 
         dataset, 
@@ -127,29 +205,74 @@ def build_loader(
         sampler = {}
         for phase in dataset:
             sampler[phase] = None
+
+    # collate on CPU (in the workers, if any) and let DeviceLoader move the batches to the device
+    num_workers = get_num_workers(num_workers)
+    to_device = arr_type == 'torch' and torch.device(device).type != 'cpu'
+    collate_device = 'cpu' if to_device else device
     
     loader = {}
     for phase in dataset:
+        batch_size = (
+            cfg.training.batch_size_train // n_device
+            if phase == 'train' 
+            else cfg.training.batch_size_eval
+        )
+        batch_sampler = None
+        if cfg.training.get('bucketing', False) and sampler[phase] is None:
+            batch_sampler = build_bucket_sampler(cfg, dataset[phase], phase, batch_size, n_device)
+        if batch_sampler is not None:
+            batching = dict(batch_sampler=batch_sampler)
+        else:
+            batching = dict(
+                batch_size=batch_size, 
+                # lazy examples are i.i.d. draws already, so there is no need to permute (possibly huge) n_data indices
+                shuffle=(phase == 'train') and sampler[phase] is None and not getattr(dataset[phase], 'lazy', False),
+                sampler=sampler[phase],
+            )
         loader[phase] = DataLoader(
             dataset[phase], 
-            batch_size=(
-                cfg.training.batch_size_train // n_device
-                if phase == 'train' 
-                else cfg.training.batch_size_eval
-            ), 
-            shuffle=(phase == 'train') and sampler[phase] is None,
-            sampler=sampler[phase],
+            **batching,
             collate_fn=partial(
-                tokenize_fn, 
+                pad_fn if isinstance(dataset[phase], PretokenizedDataset) else tokenize_fn, 
                 cfg=cfg, 
                 tokenizer=tokenizer, 
                 arr_type=arr_type,
-                device=device),
-            num_workers=num_workers,)
+                device=collate_device,
+                pack_length=get_pack_length(cfg, phase)),
+            num_workers=num_workers,
+            pin_memory=to_device and torch.device(device).type == 'cuda',
+            # persistent workers would keep their own copy of the per-epoch debug logging counters, and their RNG
+            # states across epochs (resumed checkpoints need the randomness of an epoch to depend on its start only)
+            persistent_workers=num_workers > 0 and not cfg.get('debug_samples', 0) and not cfg.training.get('checkpoint_every_steps', None),)
+        if to_device:
+            loader[phase] = DeviceLoader(loader[phase], device)
     
     return loader
 
 
+def build_subset_loader(loader, n_batches):
+    # a fixed sample of n_batches batches of a (non-shuffled) loader, evenly strided over its batches, e.g., for
+    # quick evaluations (with `training.bucketing`, the first batches would only hold the shortest examples)
+    device_loader = loader if isinstance(loader, DeviceLoader) else None
+    if device_loader is not None:
+        loader = device_loader.loader
+    batches = list(loader.batch_sampler)
+    if n_batches >= len(batches):
+        return device_loader or loader
+    picks = ((np.arange(n_batches) + 0.5) * len(batches) / n_batches).astype(int)  # middle of each stride
+    subset = DataLoader(
+        loader.dataset,
+        batch_sampler=[batches[i] for i in picks],
+        collate_fn=loader.collate_fn,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        persistent_workers=loader.persistent_workers,)
+    if device_loader is not None:
+        subset = DeviceLoader(subset, device_loader.device)
+    return subset
+
+
 def build_auxiliary_dataset(cfg):
     task_cfg = DotMap(OmegaConf.to_container(cfg.task))
     symbol = task_cfg.symbol
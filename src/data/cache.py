@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import trange
+from omegaconf import OmegaConf
+
+from src.tokenization import tokenize_for_decoder
+
+CACHE_VERSION = 1
+CACHE_ROOT = "./dataset/cache"
+
+
+################ Pre-tokenized Dataset Cache ################
+# One directory per (resolved task config, data seed, phase) holding
+#   input_ids.npy      flat token ids of all sequences (BOS ... [EOS]), trailing pads trimmed
+#   offsets.npy        (n_data+1,) start of each sequence in input_ids.npy
+#   prompt_lengths.npy (n_data,) number of leading tokens excluded from the loss
+#   position_ids.npy   (d_positions, len(input_ids)) aligned with input_ids.npy (optional)
+#   rng_state.pt       torch/numpy RNG states right after the phase was generated
+#   meta.json
+
+
+def get_cache_path(cfg, phase, seed_data=None):
+    # seed_data: the seed the data RNG was set to before build_dataset
+    seed_data = torch.initial_seed() if seed_data is None else seed_data
+    key = json.dumps({
+        'task': OmegaConf.to_container(cfg.task, resolve=True),
+        'seed_data': seed_data,
+        'version': CACHE_VERSION,
+    }, sort_keys=True)
+    return os.path.join(CACHE_ROOT, hashlib.sha1(key.encode()).hexdigest()[:16], phase)
+
+
+def is_cacheable(dataset):
+    # position IDs drawn on every access cannot be frozen; lazy datasets are not meant to be materialized
+    return not getattr(dataset, 'randomize', False) and not getattr(dataset, 'lazy', False)
+
+
+def _smallest_int_dtype(max_value):
+    for dtype in (np.int8, np.int16, np.int32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def write_cache(path, dataset, tokenizer, rng_state, batch_size=1024, verbose=True):
+    pad_token_id = tokenizer.token_to_id(tokenizer.pad_token)
+    input_ids, lengths, prompt_lengths, position_ids = [], [], [], []
+    multi_dim_positions = False
+    for start in trange(0, len(dataset), batch_size, disable=not verbose):
+        indices = list(range(start, min(start+batch_size, len(dataset))))
+        items = dataset.__getitems__(indices) if hasattr(dataset, '__getitems__') else [dataset[i] for i in indices]
+        out = tokenize_for_decoder(tokenizer, *zip(*items), arr_type='numpy')
+        ids = out['input_ids']
+        T = ids.shape[1]
+        length = T - np.argmax((ids != pad_token_id)[:, ::-1], axis=1)
+        is_label = out['labels'] != -100
+        prompt_length = np.where(is_label.any(axis=1), np.argmax(is_label, axis=1), length)
+        keep = np.arange(T)[None, :] < length[:, None]
+        input_ids.append(ids[keep])
+        lengths.append(length)
+        prompt_lengths.append(prompt_length)
+        if 'position_ids' in out:
+            pos = out['position_ids']
+            multi_dim_positions = pos.ndim == 3
+            position_ids.append(pos[keep][None] if pos.ndim == 2 else pos[:, keep])
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    input_ids = np.concatenate(input_ids)
+    np.save(f"{tmp_path}/input_ids.npy", input_ids.astype(_smallest_int_dtype(input_ids.max(initial=0))))
+    np.save(f"{tmp_path}/offsets.npy", np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(np.int64))
+    np.save(f"{tmp_path}/prompt_lengths.npy", np.concatenate(prompt_lengths).astype(np.int32))
+    if position_ids:
+        position_ids = np.concatenate(position_ids, axis=1)
+        np.save(f"{tmp_path}/position_ids.npy", position_ids.astype(_smallest_int_dtype(position_ids.max(initial=0))))
+    torch.save(rng_state, f"{tmp_path}/rng_state.pt")
+    with open(f"{tmp_path}/meta.json", "w") as f:
+        json.dump({
+            'n_data': len(dataset),
+            'dataset_cls': type(dataset).__name__,
+            'multi_dim_positions': multi_dim_positions,
+            'version': CACHE_VERSION,
+        }, f, indent=2)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process has written the same cache in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class PretokenizedDataset(Dataset):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        with open(f"{path}/meta.json") as f:
+            self.meta = json.load(f)
+        self.input_ids = np.load(f"{path}/input_ids.npy", mmap_mode='r')
+        self.offsets = np.load(f"{path}/offsets.npy")
+        self.prompt_lengths = np.load(f"{path}/prompt_lengths.npy")
+        self.position_ids = None
+        if os.path.exists(f"{path}/position_ids.npy"):
+            self.position_ids = np.load(f"{path}/position_ids.npy", mmap_mode='r')
+        self.rng_state = torch.load(f"{path}/rng_state.pt", weights_only=False)
+
+    def __len__(self):
+        return len(self.prompt_lengths)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index+1]
+        position_ids = None
+        if self.position_ids is not None:
+            position_ids = self.position_ids[:, start:end]
+            if not self.meta['multi_dim_positions']:
+                position_ids = position_ids[0]
+        return self.input_ids[start:end], self.prompt_lengths[index], position_ids
+
+
+def load_cache(path):
+    if not os.path.exists(f"{path}/meta.json"):
+        return None
+    dataset = PretokenizedDataset(path)
+    # continue from the RNG states the generation of this phase would have left behind
+    torch.set_rng_state(dataset.rng_state['torch'])
+    np.random.set_state(dataset.rng_state['numpy'])
+    return dataset
+
+
+################ END of Pre-tokenized Dataset Cache ################
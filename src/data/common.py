@@ -1,9 +1,13 @@
+import zlib
+import logging
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 
 from src.tokenization import BINARY_OPS, SpecialToken
 
+logger = logging.getLogger(__name__)
+
 
 OPERATORS = {
     '+':    {"n_input": 2, "operation": lambda x: x[0]+x[1]},
@@ -23,6 +27,140 @@ OPERATORS = {
 }
 
 
+################ Vectorized Generation Helpers ################
+# Digit matrices are little-endian: column i holds the 10**i digit.
+
+GENERATION_CHUNK_SIZE = 65536
+
+
+def sample_digit_matrix(n_digits, width, rng):
+    # uniform sampling of a number with exactly n_digits digits (0-9 if n_digits == 1)
+    n = len(n_digits)
+    digits = rng.integers(0, 10, size=(n, width), dtype=np.int8)
+    digits[np.arange(width)[None, :] >= n_digits[:, None]] = 0
+    rows = np.nonzero(n_digits > 1)[0]
+    digits[rows, n_digits[rows]-1] = rng.integers(1, 10, size=len(rows), dtype=np.int8)
+    return digits
+
+
+def count_digits(digits):
+    nonzero = digits != 0
+    n_digits = digits.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+    return np.where(nonzero.any(axis=1), n_digits, 1)
+
+
+def digit_matrix_to_chars(digits, n_digits, pad_width=0, reverse=False):
+    # ASCII matrix of the (optionally 'P'-padded) numbers; 0 marks an empty cell
+    width = max(digits.shape[1], int(np.max(pad_width, initial=0)))
+    cols = np.arange(width)[None, :]
+    chars = np.zeros((len(digits), width), dtype=np.uint8)
+    chars[:, :digits.shape[1]] = digits + ord('0')
+    chars[cols >= np.asarray(n_digits)[:, None]] = ord('P')
+    chars[cols >= np.maximum(n_digits, pad_width)[:, None]] = 0
+    return chars if reverse else chars[:, ::-1]
+
+
+def char_matrix_to_strings(chars):
+    # drop empty cells and decode every row to a str
+    chars = np.concatenate([chars, np.full((len(chars), 1), ord('\n'), dtype=np.uint8)], axis=1)
+    return chars[chars != 0].tobytes().decode('ascii').split('\n')[:-1]
+
+
+def space_strings(strings, pad_token=None):
+    # " ".join(string) (and 'P' --> pad_token) for all strings in one pass over their concatenation
+    if len(strings) == 0:
+        return []
+    codes = np.frombuffer('\n'.join(strings).encode('ascii'), dtype=np.uint8)
+    spaced = np.full(2*len(codes), ord(' '), dtype=np.uint8)
+    spaced[0::2] = codes
+    keep = np.ones(len(spaced), dtype=bool)
+    newlines = 2 * np.flatnonzero(codes == ord('\n'))
+    keep[newlines - 1] = keep[newlines + 1] = keep[-1] = False  # no white spaces around the newlines
+    text = spaced[keep].tobytes().decode('ascii')
+    if pad_token is not None:
+        text = text.replace('P', str(pad_token))
+    return text.split('\n')
+
+
+################ END of Vectorized Generation Helpers ################
+
+
+################ Vectorized Coupled Positions ################
+# The position IDs of a batch are described by segments: row b is the concatenation over s of
+#   first[b, s] + step[b, s] * arange(length[b, s])
+# so a whole batch is assembled with a few NumPy operations instead of per-example lists.
+
+
+def draw_starts(low, high, randomize=True):
+    # one start per example, uniform in [low, high) (a vectorized torch.randint); `low` if not randomize
+    low, high = np.broadcast_arrays(np.asarray(low, dtype=np.int64), np.asarray(high, dtype=np.int64))
+    if not randomize:
+        return low.copy()
+    if np.any(high <= low):
+        raise ValueError(f"cannot draw a random start from [{low.max()}, {high.min()}): max_position is too small")
+    return low + (torch.rand(low.shape, dtype=torch.float64).numpy() * (high - low)).astype(np.int64)
+
+
+def segment_positions(batchsize, segments):
+    """
+    segments: list of (first, length, step) triplets; each entry is a scalar, a (B,) or a (B, k) array.
+    Returns the flat positions of all rows (rows concatenated) and the row lengths.
+    """
+    columns = []
+    for segment in segments:
+        segment = [np.asarray(x, dtype=np.int64) for x in segment]
+        segment = [x if x.ndim == 2 else x.reshape(-1, 1) for x in segment]
+        columns.append(np.broadcast_arrays(*segment, np.empty((batchsize, 1)))[:3])
+    first, length, step = (np.concatenate(column, axis=1).ravel() for column in zip(*columns))
+    segment_ids = np.repeat(np.arange(len(length)), length)
+    offsets = np.arange(len(segment_ids)) - np.repeat(np.cumsum(length) - length, length)
+    positions = first[segment_ids] + step[segment_ids] * offsets
+    return positions, length.reshape(batchsize, -1).sum(axis=1)
+
+
+def operand_segments(starts, operand_lengths, reverse_input):
+    """
+    Coupled positions of "a1 op a2 op ... ak": the digits of every operand get start+1, ..., start+len
+    (the least significant digit the smallest one) and the operators get start.
+    operand_lengths: (B, k); a 0-length operand drops the operator in front of it as well.
+    """
+    starts = np.asarray(starts)[:, None]
+    operand_lengths = np.asarray(operand_lengths)
+    first = np.broadcast_to(starts + 1 if reverse_input else starts + operand_lengths, operand_lengths.shape)
+    step = 1 if reverse_input else -1
+    segments = []
+    for k in range(operand_lengths.shape[1]):
+        if k > 0:
+            segments.append((starts, operand_lengths[:, k:k+1] > 0, 0))
+        segments.append((first[:, k:k+1], operand_lengths[:, k:k+1], step))
+    return segments
+
+
+def split_lengths(strings, separators):
+    # (B, k) lengths of the pieces of every string split at any of the `separators`; 0 for missing pieces
+    codes = np.frombuffer(('\n'.join(strings) + '\n').encode('ascii'), dtype=np.uint8)
+    is_newline = codes == ord('\n')
+    ends = np.flatnonzero(is_newline | np.isin(codes, np.frombuffer(separators.encode('ascii'), dtype=np.uint8)))
+    rows = np.cumsum(is_newline)[ends] - 1 + ~is_newline[ends]
+    first_piece = np.searchsorted(rows, np.arange(len(strings)))
+    cols = np.arange(len(ends)) - first_piece[rows]
+    lengths = np.zeros((len(strings), cols.max(initial=0) + 1), dtype=np.int64)
+    lengths[rows, cols] = np.diff(ends, prepend=-1) - 1
+    return lengths
+
+
+def split_positions(positions, row_lengths, input_lengths):
+    # flat positions -> per-example (input_positions, label_positions) views
+    ends = np.cumsum(row_lengths)
+    starts, mids, ends = (ends - row_lengths).tolist(), (ends - row_lengths + input_lengths).tolist(), ends.tolist()
+    input_positions = [positions[start:mid] for start, mid in zip(starts, mids)]
+    label_positions = [positions[mid:end] for mid, end in zip(mids, ends)]
+    return input_positions, label_positions
+
+
+################ END of Vectorized Coupled Positions ################
+
+
 class Operation:
     def __init__(self, symbol, n_input, operation):
         self.symbol = symbol
@@ -37,6 +175,11 @@ class Operation:
 
 ## Parent Class of All Synthetic Dataset 
 class ArithmeticDataset(Dataset):
+    lazy = False
+    debug_samples = 0  # number of examples per epoch logged by `log_samples`
+    n_logged = 0
+    epoch = 0
+
     def __init__(self):
         super().__init__()
         self.inputs = []
@@ -45,12 +188,55 @@ class ArithmeticDataset(Dataset):
         self.reverse_output = False
         self.pad_token = SpecialToken.pad  # '0'
 
+    def set_lazy(self, n_data, seed_data, phase):
+        # Lazy mode: example i is regenerated on every access from (seed_data, phase, i)
+        # with a counter-based RNG, so memory does not grow with n_data.
+        # Subclasses supporting it implement `generate_batch(n, rng)`.
+        if not hasattr(self, 'generate_batch'):
+            raise NotImplementedError(f"{type(self).__name__} does not support lazy generation")
+        seed_data = torch.initial_seed() if seed_data is None else seed_data
+        self.lazy = True
+        self.n_data = n_data
+        self.rng_key = np.random.SeedSequence([seed_data, zlib.crc32(str(phase).encode())]).generate_state(2, np.uint64)
+
+    def get_rng(self, index):
+        # Philox stream of example `index`; the index occupies the highest counter word
+        return np.random.Generator(np.random.Philox(key=self.rng_key, counter=[0, 0, 0, index]))
+
+    def get_raw(self, index):
+        if self.lazy:
+            if not 0 <= index < self.n_data:
+                raise IndexError(index)
+            inputs, labels = self.generate_batch(1, self.get_rng(index))
+            return inputs[0], labels[0]
+        return self.inputs[index], self.labels[index]
+
+    def set_debug_sampling(self, n_per_epoch):
+        # opt-in: log the first `n_per_epoch` examples served in every epoch (logger 'src.data.common', DEBUG)
+        self.debug_samples = n_per_epoch
+        self.set_epoch(self.epoch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.n_logged = 0
+
+    def log_samples(self, batch):
+        if self.n_logged >= self.debug_samples:
+            return
+        for item in batch[:self.debug_samples - self.n_logged]:
+            logger.debug("(%s, epoch %d) inputs=%r labels=%r", type(self).__name__, self.epoch, item[0], item[1])
+        self.n_logged += min(len(batch), self.debug_samples - self.n_logged)
+
+    def get_raw_batch(self, indices):
+        if self.lazy:
+            return tuple(map(list, zip(*(self.get_raw(index) for index in indices))))
+        return [self.inputs[index] for index in indices], [self.labels[index] for index in indices]
+
     def __len__(self):
-        return len(self.inputs)
+        return self.n_data if self.lazy else len(self.inputs)
     
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         # Put white spaces
         inputs = " ".join(inputs).replace('P', str(self.pad_token))  # Converts 'P' --> pad_token
         labels = " ".join(labels).replace('P', str(self.pad_token))  # Converts 'P' --> pad_token
@@ -1,6 +1,7 @@
 import torch
+import numpy as np
 
-from src.data.common import ArithmeticDataset
+from src.data.common import ArithmeticDataset, draw_starts, segment_positions, split_positions
 
 
 class CopyDataset(ArithmeticDataset):
@@ -44,27 +45,35 @@ class CopyDatasetWithCoupledPositions(CopyDataset):
         self.vanilla = vanilla # not a coupled position; vanilla randomized APE
         super().__init__(n_data, min_n_digits, max_n_digits, reverse_output, **kwargs)
     
-    def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+    def __getitems__(self, indices):
+        inputs_batch, labels_batch = self.get_raw_batch(indices)
+        input_lengths = np.array(list(map(len, inputs_batch)))
+        label_lengths = np.array(list(map(len, labels_batch)))
         start_ = 1 # (self.max_position - (len(labels)+1)) // 2 + 1
         if self.vanilla:
-            pass
-            start = 1 if not self.randomize else torch.randint(1, self.max_position-len(inputs)-len(labels)+1, size=(1,)).item()
-            positions = list(range(start, start + len(inputs) + len(labels) + 1))
-            input_positions, label_positions = positions[:len(inputs)], positions[len(inputs):]
+            starts = draw_starts(1, self.max_position-input_lengths-label_lengths+1, self.randomize)
+            input_segment = (starts, input_lengths, 1)
+            label_segment = (starts+input_lengths, label_lengths+1, 1)
         else:
-            start = start_ if not self.randomize else torch.randint(1, self.max_position-len(inputs)+1, size=(1,)).item()
+            starts = draw_starts(start_, self.max_position-input_lengths+1, self.randomize)
             if self.reverse_output:
-                input_positions = list(range(start, start + len(inputs) + 1))
-                label_positions = list(range(start, start + len(inputs)))
+                input_segment = (starts, input_lengths+1, 1)
+                label_segment = (starts, input_lengths, 1)
             else:
-                input_positions = list(range(start + 1, start + len(inputs) + 1))
-                label_positions = list(range(start, start + len(inputs) + 1))
+                input_segment = (starts+1, input_lengths, 1)
+                label_segment = (starts, input_lengths+1, 1)
         if self.reverse_output:
-            labels = labels[::-1]
-            label_positions = label_positions[::-1]
+            labels_batch = [labels[::-1] for labels in labels_batch]
+            first, length, _ = label_segment
+            label_segment = (first+length-1, length, -1)
+        positions, row_lengths = segment_positions(len(indices), [input_segment, label_segment])
+        input_positions, label_positions = split_positions(positions, row_lengths, input_segment[1])
         # Put white spaces
-        inputs = " ".join(inputs)
-        labels = " ".join(labels)
-        return inputs, labels, input_positions, label_positions
\ No newline at end of file
+        inputs_batch = [" ".join(inputs) for inputs in inputs_batch]
+        labels_batch = [" ".join(labels) for labels in labels_batch]
+        batch = list(zip(inputs_batch, labels_batch, input_positions, label_positions))
+        self.log_samples(batch)
+        return batch
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
\ No newline at end of file
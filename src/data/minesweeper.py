@@ -83,8 +83,7 @@ class MineSweeperGeneratorDatasetWithCoupledPositions(MineSweeperGeneratorDatase
             reverse_output, **kwargs)
     
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         n_width = self.widths[index]
         n_height = self.heights[index]
 
@@ -1,8 +1,10 @@
 import torch
+import numpy as np
 from tqdm import tqdm, trange
 from typing import Iterable
 from src.tokenization import SpecialToken
-from src.data.common import ArithmeticDataset
+from src.data.common import ArithmeticDataset, \
+    draw_starts, segment_positions, operand_segments, split_lengths, split_positions
 
 
 ################ Helper Functions ################
@@ -107,8 +109,7 @@ class NxMMultiplicationDatasetWithCoupledPositions(NxMMultiplicationDataset):
         super().__init__(n_data, min_n_digits, max_n_digits, M, reverse_output, padding, pad_token, **kwargs)
     
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         a, b = inputs.split('*')
         max_len = len(a)
         start_ = 1 #(self.max_position - (len(labels)+1)) // 2 + 1
@@ -206,19 +207,28 @@ class MultiplicationDatasetWithCoupledPositions(MultiplicationDataset):
         super().__init__(n_data, min_n_digits_1, max_n_digits_1, min_n_digits_2, max_n_digits_2, 
             reverse_input, reverse_output, padding, pad_token, **kwargs)
 
-    def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
-        numbers = inputs.split('*')
-        start = 1 if not self.randomize else torch.randint(1, self.max_position-len(labels)+1, size=(1,)).item()
-        input_positions = sum((list(range(start, start+len(a)+1))[::1 if self.reverse_input else -1] for a in numbers), start=[])
-        input_positions = input_positions[1:] if self.reverse_input else input_positions[:-1]
-        label_positions = list(range(start, start+len(labels)+1))[::1 if self.reverse_output else -1]
-        if not self.reverse_output: label_positions = label_positions[-1:] + label_positions[:-1]
+    def __getitems__(self, indices):
+        inputs_batch, labels_batch = self.get_raw_batch(indices)
+        input_lengths = np.array(list(map(len, inputs_batch)))
+        label_lengths = np.array(list(map(len, labels_batch)))
+        starts = draw_starts(1, self.max_position-label_lengths+1, self.randomize)
+        segments = operand_segments(starts, split_lengths(inputs_batch, '*'), self.reverse_input)
+        segments.append((starts, 1, 0))  # '='
+        if self.reverse_output:
+            segments.append((starts+1, label_lengths, 1))
+        else:
+            segments.append((starts+label_lengths, label_lengths, -1))
+        positions, row_lengths = segment_positions(len(indices), segments)
+        input_positions, label_positions = split_positions(positions, row_lengths, input_lengths)
         # Put white spaces
-        inputs = " ".join(inputs).replace('P', str(self.pad_token))
-        labels = " ".join(labels).replace('P', str(self.pad_token))
-        return inputs, labels, input_positions, label_positions
+        inputs_batch = [" ".join(inputs).replace('P', str(self.pad_token)) for inputs in inputs_batch]
+        labels_batch = [" ".join(labels).replace('P', str(self.pad_token)) for labels in labels_batch]
+        batch = list(zip(inputs_batch, labels_batch, input_positions, label_positions))
+        self.log_samples(batch)
+        return batch
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
     
 
 ###############################
@@ -307,8 +317,7 @@ class MultiplicationScratchPadDatasetWithCoupledPositions(MultiplicationScratchP
             **kwargs)
 
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         A, B = inputs.split('*')
         lab_numbers_1, lab_numbers_2 = labels.split('=')
         lab_numbers_1 = lab_numbers_1.split('+')
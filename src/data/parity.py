@@ -59,8 +59,7 @@ class ParityDatasetWithCoupledPositions(ParityDataset):
         super().__init__(operation, n_data, min_n_digits, max_n_digits, **kwargs)
     
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         start = 1 if not self.randomize else torch.randint(1, self.max_position, size=(1,)).item()
         input_positions = [start] * len(inputs) + [start+1]
         label_positions = [start] * len(labels)
@@ -116,8 +115,7 @@ class ParityDatasetWithScratchpadAndCoupledPositions(ParityDatasetWithScratchpad
         super().__init__(n_data, min_n_digits, max_n_digits, reversed_scratchpad=reversed_scratchpad, **kwargs)
     
     def __getitem__(self, index):
-        inputs = self.inputs[index]
-        labels = self.labels[index]
+        inputs, labels = self.get_raw(index)
         start_ = 1 #(self.max_position - (len(labels)+1)) // 2 + 1
         start = start_ if not self.randomize else torch.randint(1, self.max_position-len(inputs)+1, size=(1,)).item()
         
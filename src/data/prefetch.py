@@ -0,0 +1,69 @@
+import os
+import torch
+
+
+################ Worker-Safe Loading ################
+# With `num_workers > 0` the collators run in worker processes, where CUDA must not be touched:
+# batches are collated into CPU tensors (moved to shared memory by the DataLoader, then pinned),
+# and `DeviceLoader` copies them to the device from the main process, one batch ahead.
+
+
+def get_num_workers(num_workers='auto'):
+    # `training.num_workers: auto`: one worker per spare CPU core (at most 8)
+    if num_workers != 'auto':
+        return int(num_workers)
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return min(max((n_cpus or 1) - 1, 0), 8)
+
+
+def to_device(batch, device, non_blocking=False):
+    return {k: v.to(device, non_blocking=non_blocking) for k, v in batch.items()}
+
+
+class DeviceLoader:
+    """
+    Iterates over a DataLoader of CPU batches, yielding them on `device`.
+    On CUDA, the (pinned) batch after the current one is already being copied on a side stream,
+    so host-to-device transfers overlap with the computation on the current batch.
+    Other attributes (`dataset`, `sampler`, `batch_sampler`, ...) are those of the DataLoader.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+
+        def prefetch():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return to_device(batch, self.device, non_blocking=True)
+
+        next_batch = prefetch()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for v in batch.values():
+                v.record_stream(current_stream)  # allocated on the side stream, used on the current one
+            next_batch = prefetch()
+            yield batch
+
+
+################ END of Worker-Safe Loading ################
@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from src.data.cache import PretokenizedDataset
+
+
+################ Length-Bucketed Batching ################
+# The collators pad every batch to its longest member; grouping examples of similar length
+# into the same batch keeps the padded (and attended) tokens close to the real ones.
+
+
+def count_tokens(strings):
+    # number of non-space characters of every string (= tokens for the single-character vocabularies)
+    codes = np.frombuffer(('\n'.join(strings) + '\n').encode(), dtype=np.uint8)
+    is_newline = codes == ord('\n')
+    n_chars = np.cumsum((codes != ord(' ')) & ~is_newline)[is_newline]
+    return np.diff(n_chars, prepend=0)
+
+
+def get_token_lengths(dataset):
+    # (approximate) length of every tokenized example; None if it is not known without generating it
+    if isinstance(dataset, PretokenizedDataset):
+        return np.diff(dataset.offsets)
+    if getattr(dataset, 'lazy', False) or not hasattr(dataset, 'inputs') or len(dataset.inputs) != len(dataset):
+        return None
+    return count_tokens(dataset.inputs) + count_tokens(dataset.labels) + 3  # [BOS], '=', [EOS]
+
+
+def padding_efficiency(lengths, batches):
+    # fraction of real tokens among all tokens of the padded batches
+    n_padded = sum(len(batch) * lengths[batch].max() for batch in batches if len(batch))
+    return lengths.sum() / max(n_padded, 1)
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler (`DataLoader(batch_sampler=...)`) grouping examples of similar length.
+    Every epoch, the (shuffled) indices are cut into buckets of `bucket_size` batches; each bucket
+    is sorted by length and split into batches, and the batches of all buckets are shuffled.
+    A batch holds `batch_size` examples, or, with `max_tokens`, as many examples as fit in
+    `max_tokens` padded tokens (examples x longest length).
+    """
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=True, bucket_size=100, drop_last=False, seed=None):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("LengthBucketSampler needs batch_size or max_tokens")
+        self.lengths = np.asarray(lengths)
+        if max_tokens is not None and max_tokens < self.lengths.max(initial=0):
+            raise ValueError(f"max_tokens={max_tokens} is smaller than the longest example ({self.lengths.max()} tokens)")
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = torch.randint(2**62, size=(1,)).item() if seed is None else seed
+        self.epoch = 0
+        self.batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = None
+
+    def split_bucket(self, indices):
+        # indices: sorted by length
+        if self.max_tokens is None:
+            batches = np.split(indices, range(self.batch_size, len(indices), self.batch_size))
+            return [batch for batch in batches if len(batch) == self.batch_size or not self.drop_last]
+        batches, start = [], 0
+        for end, length in enumerate(self.lengths[indices].tolist()):
+            if (end + 1 - start) * length > self.max_tokens:
+                batches.append(indices[start:end])
+                start = end
+        batches.append(indices[start:])
+        return batches
+
+    def get_batches(self):
+        if self.batches is None:
+            rng = np.random.default_rng([self.seed, self.epoch])
+            n = len(self.lengths)
+            order = rng.permutation(n) if self.shuffle else np.arange(n)
+            batch_size = self.batch_size or max(1, self.max_tokens // max(int(np.median(self.lengths)), 1))
+            bucket = self.bucket_size * batch_size
+            self.batches = []
+            for start in range(0, n, bucket):
+                indices = order[start:start+bucket]
+                self.batches.extend(self.split_bucket(indices[np.argsort(self.lengths[indices], kind='stable')]))
+            if self.shuffle:
+                self.batches = [self.batches[i] for i in rng.permutation(len(self.batches))]
+        return self.batches
+
+    def padding_efficiency(self):
+        return padding_efficiency(self.lengths, self.get_batches())
+
+    def __iter__(self):
+        batches = self.get_batches()
+        self.set_epoch(self.epoch + 1)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+################ END of Length-Bucketed Batching ################
@@ -1,6 +1,8 @@
 import torch
 import re
-from src.data.common import ArithmeticDataset
+import numpy as np
+from src.data.common import ArithmeticDataset, \
+	draw_starts, segment_positions, operand_segments, split_lengths, split_positions
 
 class VariedDatasetWithCoupledPositions(ArithmeticDataset):    
 	"""
@@ -92,56 +94,31 @@ class VariedDatasetWithCoupledPositions(ArithmeticDataset):
 				num = ''.join(map(str, num_arr))
 		return num
 
-	def __getitem__(self, index):
-		inp = self.inputs[index]
-		label = self.labels[index]
-
-		input_nums = re.split(r'[+\-*]', inp)
-		max_digits_in_input = max(len(num) for num in input_nums)
-	
-		input_num_positions = []
-
-		# no ned for this anytmore, padding is done upon object construction
-		# if self.padding:
-		# 	# pad each input number to max_digits
-		# 	for j in range(len(input_nums)):
-		# 		if len(input_nums[j]) < max_digits_in_input:
-		# 			input_nums[j] = input_nums[j].rjust(max_digits_in_input, self.pad_token)
+	def __getitems__(self, indices):
+		inputs_batch, labels_batch = self.get_raw_batch(indices)
+		input_lengths = np.array(list(map(len, inputs_batch)))
+		label_lengths = np.array(list(map(len, labels_batch)))
+		input_num_lengths = split_lengths(inputs_batch, '+-*')
 
 		# generate positions
-		start_pos_offset = max(max_digits_in_input, len(label))
-		start = 1 if not self.randomize else torch.randint(1, self.max_position-start_pos_offset+(1 if self.reverse_output else 0), size=(1,)).item()
-		
-		# print(f"Varied.getitem: input nums are: {input_nums}, patterm: {self.pattern}")
-
-		for n in input_nums:
-			# generate positions for each number in the input expr
-			num_positions = list(range(start+1, start+1 + len(n)))
-			input_num_positions.append(num_positions)
-
-		# print(f"Varied.getitem: input_num_positions are: {input_num_positions}")
+		start_pos_offset = np.maximum(input_num_lengths.max(axis=1), label_lengths)
+		starts = draw_starts(1, self.max_position-start_pos_offset+(1 if self.reverse_output else 0), self.randomize)
 
-		if not self.reverse_input: # reverse all the positions
-			# refer to addition.py - the positions are already reversed so re-reverse them if reverse_input==False
-			input_num_positions = [list(reversed(positions)) for positions in input_num_positions]
-		
-		# print("Varied.getitem: after reverse_input check, input_num_positions are: ", input_num_positions)
-
-		# piece all input positions (and positions of the operators) into one long arr
-		final_input_positions = []
-		for positions in input_num_positions:
-			final_input_positions.extend(positions)
-			final_input_positions.append(start) # the operator
-
-		# remove extra operator position
-		final_input_positions.pop()
-
-		ans_positions = list(range(start+1, start+1+len(label)))
+		# digits of every number get start+1, ... (reversed if reverse_input==False, refer to addition.py), operators get start
+		segments = operand_segments(starts, input_num_lengths, self.reverse_input)
 		if self.reverse_output:
-				eq_position = start
+			segments.append((starts, label_lengths+1, 1))  # '=' at start
 		else:
-				ans_positions = ans_positions[::-1]
-				eq_position = start+len(label)+1
-		label_positions = [eq_position] + ans_positions
+			segments.append((starts+label_lengths+1, label_lengths+1, -1))
+		positions, row_lengths = segment_positions(len(indices), segments)
+		input_positions, label_positions = split_positions(positions, row_lengths, input_lengths)
+
+		batch = [
+			(" ".join(inp), " ".join(label), inp_pos, lab_pos)
+			for inp, label, inp_pos, lab_pos in zip(inputs_batch, labels_batch, input_positions, label_positions)
+		]
+		self.log_samples(batch)
+		return batch
 
-		return " ".join(inp), " ".join(label), final_input_positions, label_positions
\ No newline at end of file
+	def __getitem__(self, index):
+		return self.__getitems__([index])[0]
\ No newline at end of file
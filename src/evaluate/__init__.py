@@ -1 +1,2 @@
-from .accuracy import *
\ No newline at end of file
+from .accuracy import *
+from .generation import *
\ No newline at end of file
@@ -21,16 +21,38 @@ def get_tokenwise_accuracy(cfg, predictions, references, pad_token_id, division=
         return correct, samples
 
 
-def get_instancewise_accuracy(cfg, predictions, references, pad_token_id, division=True, return_arr=False):
+def get_teacher_forced_accuracy(output, pad_token_id):
+    # tokenwise and instancewise counts from the label tokens of `CustomDecoderOnlyT5.forward_eval`
+    is_token = output.targets != pad_token_id
+    tokenwise_correct = torch.logical_and(output.predictions == output.targets, is_token).sum()
+    num_tokens = is_token.sum()
+    instancewise_correct = output.instance_correct.sum()
+    return tokenwise_correct, num_tokens, instancewise_correct, len(output.instance_correct)
+
+
+def get_instancewise_accuracy(cfg, predictions, references, pad_token_id, division=True, return_arr=False, segment_ids=None):
     device = predictions.device
     references = references.to(device)
+    if segment_ids is not None:
+        segment_ids = segment_ids.to(device)
+        n_segments = segment_ids.max(dim=1).values
     if cfg.model.model_name in DECODER_BASED:
         predictions = predictions[..., :-1]
         references = references[..., 1:]
+        if segment_ids is not None:
+            segment_ids = segment_ids[..., 1:]
     pad_mask = torch.logical_or(references == pad_token_id, references == -100)
     acc_mask = predictions == references
     mask = torch.logical_or(acc_mask, pad_mask)
-    acc = torch.sum(mask, dim=1) == references.size(1)
+    if segment_ids is None:
+        acc = torch.sum(mask, dim=1) == references.size(1)
+    else:
+        # packed rows: every segment (1, 2, ..., n_segments; 0 for pads) is an instance
+        n_wrong = torch.zeros(len(mask), segment_ids.size(1)+1, dtype=torch.long, device=device)
+        n_wrong.scatter_add_(1, segment_ids, (~mask).long())
+        is_segment = torch.arange(n_wrong.size(1), device=device)[None, :] <= n_segments[:, None]
+        is_segment[:, 0] = False
+        acc = (n_wrong == 0)[is_segment]
     correct = torch.sum(acc)
     samples = len(acc)
     accuracy = correct / samples
@@ -0,0 +1,194 @@
+import torch
+
+from src.model.build_model import CUSTOM_T5_DECODER_ONLY, CUSTOM_GPT2
+from src.model.modeling.kv_cache import StaticKVCache
+from src.model.modeling.positional_embeddings import (
+    POSITION_ENCODING_FIRE,
+    POSITION_ENCODING_REL_TRANSFORMER_XL,
+    POSITION_ENCODING_ROTARY_OLD,
+    POSITION_ENCODING_ROTARY_NEW,
+)
+
+
+################ Greedy Decoding ################
+# Batched greedy decoding for the decoder-only models (CustomT5DecoderOnly, CustomGPT2).
+# The answer of a "[BOS] {inp} = {lab} [EOS]" row is generated token by token from its prompt "[BOS] {inp} =",
+# with the (coupled) position ids the dataset assigns to the answer tokens, and compared with the label.
+
+GREEDY_DECODING_MODELS = [CUSTOM_T5_DECODER_ONLY, CUSTOM_GPT2]
+
+CACHE_STATIC = "static"    # preallocated buffers written in place (StaticKVCache)
+CACHE_DYNAMIC = "dynamic"  # past_key_values tuples grown by torch.cat
+CACHE_NONE = "none"        # the whole sequence is recomputed at every step
+
+# attention depending on the row index of the queries (not on the key/query positions): no KV cache
+NO_CACHE_POSITION_ENCODINGS = [POSITION_ENCODING_FIRE, POSITION_ENCODING_REL_TRANSFORMER_XL]
+# rotary variants whose rotation offset is the length of the past keys
+DYNAMIC_CACHE_POSITION_ENCODINGS = [POSITION_ENCODING_ROTARY_OLD, POSITION_ENCODING_ROTARY_NEW]
+
+
+def get_cache_type(model):
+    model = getattr(model, '_orig_mod', model)  # torch.compile
+    position_encoding_type = getattr(model.config, 'position_encoding_type', None)
+    if position_encoding_type in NO_CACHE_POSITION_ENCODINGS:
+        return CACHE_NONE
+    if position_encoding_type in DYNAMIC_CACHE_POSITION_ENCODINGS:
+        return CACHE_DYNAMIC
+    return CACHE_STATIC
+
+
+def split_prompts(batch, pad_token_id):
+    """
+    Split a (right-padded) decoder batch into left-padded prompts and their answers.
+    Returns
+        input_ids, attention_mask: (batch_size, prompt_length), prompts "[BOS] {inp} =" aligned to the right
+        position_ids: (..., batch_size, prompt_length + max_new_tokens), position ids of the prompts and of the
+            answer tokens (the dataset positions if any, otherwise 0, 1, ... from [BOS])
+        targets: (batch_size, max_new_tokens), answer tokens "{lab} [EOS]" (-100 after the answer)
+    """
+    input_ids, labels = batch['input_ids'], batch['labels']
+    device = input_ids.device
+    labels = labels.to(device)
+    seq_length = input_ids.size(-1)
+
+    is_label = labels != -100
+    prompt_lengths = is_label.int().argmax(-1)  # column of the first answer token
+    answer_lengths = is_label.sum(-1)
+    prompt_length = prompt_lengths.max().item()
+    max_new_tokens = answer_lengths.max().item()
+
+    # column of the batch of every column of the left-aligned rows (negative: left padding)
+    cols = torch.arange(prompt_length + max_new_tokens, device=device) - (prompt_length - prompt_lengths)[:, None]
+    valid = (cols >= 0) & (cols < seq_length)
+    src = cols.clamp(0, seq_length - 1)
+
+    prompt_mask = valid[:, :prompt_length]
+    prompts = torch.where(prompt_mask, input_ids.gather(1, src[:, :prompt_length]), pad_token_id)
+
+    answer = torch.arange(max_new_tokens, device=device)
+    targets = labels.gather(1, (prompt_lengths[:, None] + answer).clamp(max=seq_length - 1))
+    targets = targets.masked_fill(answer >= answer_lengths[:, None], -100)
+
+    position_ids = batch.get('position_ids')
+    if position_ids is None:
+        position_ids = cols.clamp(min=0)
+    else:
+        position_ids = position_ids.to(device)
+        position_ids = position_ids.gather(-1, src.expand(*position_ids.shape[:-1], -1)).masked_fill(~valid, 0)
+
+    return prompts, prompt_mask.long(), position_ids, targets
+
+
+def left_to_right_padding(attention_mask, *tensors):
+    # move the left padding of every row to the right: the models without KV cache recompute the whole
+    # sequence laid out as in training (their attention depends on the row index of the tokens)
+    length = attention_mask.size(-1)
+    cols = torch.arange(length, device=attention_mask.device) + (length - attention_mask.sum(-1, keepdim=True))
+    valid = cols < length
+    cols = cols.clamp(max=length - 1)
+    return [t.gather(-1, cols.expand(*t.shape[:-1], -1)).masked_fill(~valid, 0) for t in (attention_mask, *tensors)]
+
+
+@torch.no_grad()
+def greedy_decode(model, input_ids, attention_mask, position_ids, max_new_tokens, eos_token_id=None, pad_token_id=0, cache=None):
+    """
+    Batched greedy decoding from left-padded prompts (see `split_prompts`).
+    position_ids: (..., batch_size, prompt_length + max_new_tokens), precomputed position ids of the prompts and of the
+        tokens to generate; every step gets those of the whole sequence (so far), as the coupled relative bias needs
+        the positions of the cached keys as well.
+    cache: CACHE_STATIC, CACHE_DYNAMIC or CACHE_NONE (default: the best one supported by the model, `get_cache_type`).
+        With CACHE_STATIC, every step after the prompt has the same shapes.
+    A row stops at eos_token_id (the following tokens are pad_token_id); decoding stops once all rows have.
+    Returns the generated tokens, (batch_size, max_new_tokens).
+    """
+    if cache is None:
+        cache = get_cache_type(model)
+    batch_size, prompt_length = input_ids.shape
+    generated = input_ids.new_full((batch_size, max_new_tokens), pad_token_id)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+
+    tokens, past_key_values = input_ids, None
+    if cache == CACHE_STATIC:
+        model_config = getattr(model, '_orig_mod', model).config
+        past_key_values = StaticKVCache(model_config.num_hidden_layers, prompt_length + max_new_tokens)
+        # the mask covers all the slots (those after a query are masked out by the cache)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(batch_size, max_new_tokens)], dim=1)
+
+    for step in range(max_new_tokens):
+        length = prompt_length + step
+        if cache == CACHE_STATIC:
+            outputs = model(
+                input_ids=tokens,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            logits = outputs.logits[:, -1]
+        elif cache == CACHE_DYNAMIC:
+            outputs = model(
+                input_ids=tokens,
+                attention_mask=attention_mask,
+                position_ids=position_ids[..., :length],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            logits = outputs.logits[:, -1]
+        else:
+            mask, ids, pids = left_to_right_padding(attention_mask, tokens, position_ids[..., :length])
+            logits = model(input_ids=ids, attention_mask=mask, position_ids=pids, use_cache=False).logits
+            logits = logits[torch.arange(batch_size, device=logits.device), mask.sum(-1) - 1]
+        next_tokens = logits.argmax(-1).masked_fill(finished, pad_token_id)
+        generated[:, step] = next_tokens
+        if eos_token_id is not None:
+            finished |= next_tokens == eos_token_id
+            if finished.all():
+                break
+
+        if cache == CACHE_NONE:
+            tokens = torch.cat([tokens, next_tokens[:, None]], dim=1)  # recompute the whole sequence
+        else:
+            tokens = next_tokens[:, None]
+        if cache == CACHE_DYNAMIC:
+            past_key_values = outputs.past_key_values
+        if cache != CACHE_STATIC:
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones(batch_size, 1)], dim=1)
+    return generated
+
+
+def exact_match(generated, targets):
+    # every answer token (up to [EOS]) is generated
+    is_answer = targets != -100
+    return ((generated == targets) | ~is_answer).all(-1)
+
+
+def generate_for_batch(cfg, model, batch, tokenizer, cache=None):
+    # greedy answers of a collated decoder batch: prompts (left-padded), generated tokens and targets
+    if cfg.model.model_name not in GREEDY_DECODING_MODELS:
+        raise ValueError(f"greedy decoding is not supported for model_name: {cfg.model.model_name}")
+    input_ids, attention_mask, position_ids, targets = split_prompts(batch, tokenizer.pad_token_id)
+    generated = greedy_decode(
+        model, input_ids, attention_mask, position_ids, targets.size(-1),
+        eos_token_id=tokenizer.eos_token_id if cfg.task.eos else None,
+        pad_token_id=tokenizer.pad_token_id,
+        cache=cache,
+    )
+    return input_ids, generated, targets
+
+
+def get_generation_accuracy(cfg, model, batch, tokenizer, division=True, return_arr=False, cache=None):
+    # exact-match accuracy of the greedy answers
+    _, generated, targets = generate_for_batch(cfg, model, batch, tokenizer, cache=cache)
+    acc = exact_match(generated, targets)
+    if return_arr:
+        return acc
+    correct = acc.sum()
+    samples = acc.size(0)
+    if division:
+        accuracy = correct / samples
+        return accuracy
+    else:
+        return correct, samples
+
+
+################ END of Greedy Decoding ################
@@ -9,4 +9,5 @@ from transformers import (
 )
 from .modeling.custom_t5_decoder_only import CustomDecoderOnlyT5
 from .modeling.custom_gpt2 import CustomGPT2Config, CustomGPT2LMHeadModel
+from .modeling.kv_cache import StaticKVCache
 from .build_model import build_model_from_scratch, build_auxiliary_model, DECODER_BASED, ENCODER_DECODER_BASED
\ No newline at end of file
@@ -35,6 +35,7 @@ from src.model.modeling.positional_embeddings import (
     POSITION_ENCODING_ABS_LEARNED,
     POSITION_ENCODING_NONE,
 )
+from src.model.modeling.kv_cache import StaticKVCache
 
 
 logger = logging.get_logger(__name__)
@@ -414,7 +415,10 @@ class CustomGPT2Attention(nn.Module):
         key = self._split_heads(key, self.num_heads, self.head_dim)
         value = self._split_heads(value, self.num_heads, self.head_dim)
 
-        if layer_past is not None:
+        if isinstance(layer_past, StaticKVCache):
+            # written in the preallocated buffers, whose slots are all attended (masked by the model)
+            key, value = layer_past.update(self.layer_idx, key, value)
+        elif layer_past is not None:
             past_key, past_value = layer_past
             key = torch.cat((past_key, key), dim=-2)
             value = torch.cat((past_value, value), dim=-2)
@@ -689,12 +693,25 @@ class CustomGPT2Model(CustomGPT2PreTrainedModel):
 
         if token_type_ids is not None:
             token_type_ids = token_type_ids.view(-1, input_shape[-1])
-        if position_ids is not None:
-            position_ids = position_ids.view(-1, input_shape[-1])
+        static_cache = past_key_values if isinstance(past_key_values, StaticKVCache) else None
+        if static_cache is not None:
+            # position_ids and attention_mask cover all the slots of the cache; the current tokens take the next ones
+            cache_position = static_cache.advance(input_shape[-1], device)
+            if position_ids is None:
+                position_ids = torch.arange(static_cache.max_length, device=device)
+            if attention_mask is None:
+                attention_mask = torch.ones(batch_size, static_cache.max_length, device=device)
+            position_ids = position_ids.index_select(-1, cache_position).reshape(-1, input_shape[-1])
+        elif position_ids is not None:
+            # position_ids may also cover the past tokens: the last ones are those of the current tokens
+            position_ids = position_ids[..., -input_shape[-1]:].reshape(-1, input_shape[-1])
 
         if past_key_values is None:
             past_length = 0
             past_key_values = tuple([None] * len(self.h))
+        elif static_cache is not None:
+            past_length = 0
+            past_key_values = tuple([static_cache] * len(self.h))
         else:
             past_length = past_key_values[0][0].size(-2)
         if position_ids is None:
@@ -711,7 +728,11 @@ class CustomGPT2Model(CustomGPT2PreTrainedModel):
             # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
             # this attention mask is more simple than the triangular masking of causal attention
             # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-            attention_mask = attention_mask[:, None, None, :]
+            if static_cache is not None:
+                # causal w.r.t. the slots of the cache: [batch_size, 1, from_seq_length, max_length]
+                attention_mask = static_cache.get_attention_mask(attention_mask)[:, None, :, :]
+            else:
+                attention_mask = attention_mask[:, None, None, :]
 
             # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
             # masked positions, this operation will create a tensor which is 0.0 for
@@ -813,6 +834,9 @@ class CustomGPT2Model(CustomGPT2PreTrainedModel):
                     if i == v[-1] and "cuda:" + str(k) != self.last_device:
                         hidden_states = hidden_states.to("cuda:" + str(k + 1))
 
+        if use_cache is True and static_cache is not None:
+            presents = static_cache
+
         hidden_states = self.ln_f(hidden_states)
 
         hidden_states = hidden_states.view(output_shape)
@@ -4,6 +4,7 @@
 import logging
 import math
 import os
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Tuple, Dict
 
@@ -15,6 +16,7 @@ from transformers import PretrainedConfig, T5Config
 from transformers.modeling_outputs import (
     CausalLMOutputWithPast,
     BaseModelOutputWithPastAndCrossAttentions,
+    ModelOutput,
 )
 from transformers.models.t5.modeling_t5 import (
     T5Stack,
@@ -38,7 +40,11 @@ from tokenizers import Tokenizer
 
 logger = logging.getLogger("app")
 
+ATTENTION_BACKEND_EAGER = "eager"
+ATTENTION_BACKEND_SDPA = "sdpa"
+
 from src.model.modeling.positional_embeddings import *
+from src.model.modeling.kv_cache import StaticKVCache
 
 
 ############# Normalization Layer ##############
@@ -119,6 +125,10 @@ class CustomT5Attention(T5Attention):
                 "when creating this class."
             )
         
+        self.attention_backend = getattr(config, 'attention_backend', None) or ATTENTION_BACKEND_EAGER
+        if self.attention_backend not in [ATTENTION_BACKEND_EAGER, ATTENTION_BACKEND_SDPA]:
+            raise ValueError(f"{self.attention_backend} is not implemented attention backend.")
+
         self.tempered_softmax = getattr(config, 'tempered_softmax', False)  # boolean
         if self.tempered_softmax:
             self.tau = torch.nn.Parameter(torch.normal(0., getattr(config, 'tempered_softmax_std', 0.02), (1,)).float())
@@ -223,6 +233,12 @@ class CustomT5Attention(T5Attention):
 
         real_seq_length = seq_length
 
+        static_cache = None
+        if isinstance(past_key_value, StaticKVCache):
+            # the keys/values of the current tokens are written in the preallocated buffers, whose slots are all attended
+            static_cache, past_key_value = past_key_value, None
+            real_seq_length = static_cache.max_length
+
         if past_key_value is not None:
             assert (
                 len(past_key_value) == 2
@@ -273,11 +289,8 @@ class CustomT5Attention(T5Attention):
             self.q(hidden_states)
         )  # (batch_size, n_heads, seq_length, dim_per_head)
 
-        # get key states
-        if self.position_encoding_type in [
-            POSITION_ENCODING_ROTARY_OLD,
-            POSITION_ENCODING_ROTARY_NEW,
-        ]:
+        # get key states (rotary variants rotate the new keys before appending them to the past ones)
+        if self.position_encoding_type.startswith('rotary_'):
             key_states = shape(self.k(hidden_states))
         else:
             key_states = project(
@@ -294,9 +307,15 @@ class CustomT5Attention(T5Attention):
             key_value_states,
             past_key_value[1] if past_key_value is not None else None,
         )
+        if static_cache is not None and not self.position_encoding_type.startswith('rotary_'):
+            key_states, value_states = static_cache.update(self.layer_idx, key_states, value_states)
 
         attention_output_dict = {}
 
+        # The no-PE, rotary, ALiBi and coupled relative bias variants only build an additive `attn_bias`
+        # (scores=None), which is applied below by either the eager or the fused attention.
+        scores, attn_bias = None, None
+
         if self.position_encoding_type == POSITION_ENCODING_REL_T5_BIAS:
             scores = torch.matmul(query_states, key_states.transpose(3, 2))
             attention_output_dict["scores_before"] = scores
@@ -314,7 +333,9 @@ class CustomT5Attention(T5Attention):
 
                 # if key and values are already calculated
                 # we want only the last query position bias
-                if past_key_value is not None:
+                if static_cache is not None:
+                    position_bias = position_bias.index_select(2, static_cache.cache_position)
+                elif past_key_value is not None:
                     position_bias = position_bias[:, :, -hidden_states.size(1) :, :]
 
                 if mask is not None:
@@ -366,52 +387,25 @@ class CustomT5Attention(T5Attention):
                 r_offset = past_key_value[0].shape[2]
                 r_seq_len += r_offset
 
-            query_states = query_states.permute(0, 2, 1, 3)
-            key_states = key_states.permute(0, 2, 1, 3)
-
-            if self.rotary_dim is not None:
-
-                k_rot = key_states[:, :, :, : self.rotary_dim]
-                k_pass = key_states[:, :, :, self.rotary_dim :]
-
-                q_rot = query_states[:, :, :, : self.rotary_dim]
-                q_pass = query_states[:, :, :, self.rotary_dim :]
-
-                sincos = fixed_pos_embedding(k_rot, 1, seq_len=r_seq_len)
-                k_rot = apply_rotary_pos_emb_old(k_rot, sincos, offset=r_offset)
-                q_rot = apply_rotary_pos_emb_old(q_rot, sincos, offset=r_offset)
-
-                if output_attentions:
-                    scores_pass = torch.matmul(
-                        q_pass.permute(0, 2, 1, 3),
-                        k_pass.permute(0, 2, 1, 3).transpose(3, 2),
-                    )
-                    attention_output_dict["scores_pass"] = scores_pass
-
-                    scores_rot = torch.matmul(
-                        q_rot.permute(0, 2, 1, 3),
-                        k_rot.permute(0, 2, 1, 3).transpose(3, 2),
-                    )
-                    attention_output_dict["scores_rot"] = scores_rot
-
-                key_states = torch.cat([k_rot, k_pass], dim=-1)
-                query_states = torch.cat([q_rot, q_pass], dim=-1)
-            else:
-                sincos = fixed_pos_embedding(key_states, 1, seq_len=r_seq_len)
-                key_states = apply_rotary_pos_emb_old(key_states, sincos, offset=r_offset)
-                query_states = apply_rotary_pos_emb_old(query_states, sincos, offset=r_offset)
+            # rotated in the (batch_size, n_heads, seq_length, d_head) layout (see `apply_partial_rotary_pos_emb`)
+            rotary_dim = self.rotary_dim if self.rotary_dim is not None else self.key_value_proj_dim
+            sin, cos = fixed_pos_embedding(key_states[..., :rotary_dim], seq_len=r_seq_len)
+            sin, cos = sin[r_offset:r_offset + query_states.size(2)], cos[r_offset:r_offset + query_states.size(2)]
+            query_states = apply_partial_rotary_pos_emb(query_states, cos, sin, rotary_dim, interleaved=True)
+            key_states = apply_partial_rotary_pos_emb(key_states, cos, sin, rotary_dim, interleaved=True)
 
-            query_states = query_states.permute(0, 2, 1, 3)
-            key_states = key_states.permute(0, 2, 1, 3)
+            if self.rotary_dim is not None and output_attentions:
+                attention_output_dict["scores_pass"] = torch.matmul(
+                    query_states[..., rotary_dim:], key_states[..., rotary_dim:].transpose(3, 2)
+                )
+                attention_output_dict["scores_rot"] = torch.matmul(
+                    query_states[..., :rotary_dim], key_states[..., :rotary_dim].transpose(3, 2)
+                )
 
             if past_key_value is not None:
                 key_states = torch.cat([past_key_value[0], key_states], dim=2)
 
-            scores = torch.matmul(
-                query_states, key_states.transpose(3, 2)
-            )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
-            if mask is not None:
-                scores += mask  # (batch_size, n_heads, seq_length, key_length)
+            attn_bias = mask  # (batch_size, n_heads, seq_length, key_length)
 
         elif self.position_encoding_type == POSITION_ENCODING_ROTARY_NEW:
             r_seq_len = hidden_states.shape[1]
@@ -421,89 +415,52 @@ class CustomT5Attention(T5Attention):
                 r_offset = past_key_value[0].shape[2]
                 r_seq_len += r_offset
 
-            query_states = query_states.permute(0, 2, 1, 3)
-            key_states = key_states.permute(0, 2, 1, 3)
-
-            if self.rotary_dim is not None:
-                k_rot = key_states[:, :, :, : self.rotary_dim]
-                k_pass = key_states[:, :, :, self.rotary_dim :]
-
-                q_rot = query_states[:, :, :, : self.rotary_dim]
-                q_pass = query_states[:, :, :, self.rotary_dim :]
-
-                sincos = position_bias
-                # sincos is just vector created by torch.cat([sin, cos], dim=-1)
-                # so we can just split it in half
-                sin = sincos[:, :, : self.rotary_dim // 2]
-                cos = sincos[:, :, self.rotary_dim // 2 :]
-
-                # We don't need to pass offset here, because we already used
-                # position_ids to retrieve correct sin and cos vectors
-                k_rot = apply_rotary_pos_emb_new(k_rot, (sin, cos))
-                q_rot = apply_rotary_pos_emb_new(q_rot, (sin, cos))
-
-                key_states = torch.cat([k_rot, k_pass], dim=-1)
-                query_states = torch.cat([q_rot, q_pass], dim=-1)
-            else:
+            if self.rotary_dim is None:
                 raise ValueError("rotary_dim is None")
 
-            query_states = query_states.permute(0, 2, 1, 3)
-            key_states = key_states.permute(0, 2, 1, 3)
+            sincos = position_bias
+            # sincos is just vector created by torch.cat([sin, cos], dim=-1)
+            # so we can just split it in half: (batch_size, 1, seq_length, rotary_dim // 2)
+            sin = sincos[:, None, :, : self.rotary_dim // 2]
+            cos = sincos[:, None, :, self.rotary_dim // 2 :]
+
+            # We don't need to pass offset here, because we already used
+            # position_ids to retrieve correct sin and cos vectors
+            query_states = apply_partial_rotary_pos_emb(query_states, cos, sin, self.rotary_dim, interleaved=True)
+            key_states = apply_partial_rotary_pos_emb(key_states, cos, sin, self.rotary_dim, interleaved=True)
 
             if past_key_value is not None:
                 key_states = torch.cat([past_key_value[0], key_states], dim=2)
 
-            scores = torch.matmul(
-                query_states, key_states.transpose(3, 2)
-            )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
-            if mask is not None:
-                scores += mask  # (batch_size, n_heads, seq_length, key_length)
+            attn_bias = mask  # (batch_size, n_heads, seq_length, key_length)
 
         elif self.position_encoding_type.startswith('rotary_'):
             # query_states, key_states: (batch_size, n_heads, seq_length, d_head)
-            q_rot = query_states[..., :self.rotary_dim]
-            q_pass = query_states[..., self.rotary_dim:]
-            k_rot = key_states[..., :self.rotary_dim]
-            k_pass = key_states[..., self.rotary_dim:]
-
+            # cos, sin: (batch_size, seq_length, rotary_dim), the same angles repeated in both halves
             cos, sin = position_bias
-            q_rot, k_rot = apply_rotary_pos_emb(q_rot, k_rot, cos, sin, unsqueeze_dim=1)
-
-            query_states = torch.cat([q_rot, q_pass], dim=-1)
-            key_states = torch.cat([k_rot, k_pass], dim=-1)
-
-            if past_key_value is not None:
-                key_states = torch.cat([past_key_value[0], key_states], dim=-1)
+            cos = cos[:, None, :, :self.rotary_dim // 2]
+            sin = sin[:, None, :, :self.rotary_dim // 2]
+            query_states = apply_partial_rotary_pos_emb(query_states, cos, sin, self.rotary_dim)
+            key_states = apply_partial_rotary_pos_emb(key_states, cos, sin, self.rotary_dim)
 
-            scores = torch.matmul(
-                query_states, key_states.transpose(3, 2)
-            )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
-            if mask is not None:
-                scores += mask  # (batch_size, n_heads, seq_length, key_length)
-
-        elif self.position_encoding_type == POSITION_ENCODING_ALIBI:
-            scores = torch.matmul(query_states, key_states.transpose(3, 2))
-            attention_output_dict["scores_before"] = scores
-
-            alibi = position_bias
-            alibi = alibi.view(batch_size, self.n_heads, 1, key_length)
-
-            # if key and values are already calculated
-            # we want only the last query position bias
             if past_key_value is not None:
-                alibi = alibi[:, :, -hidden_states.size(1) :, :]
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            elif static_cache is not None:
+                key_states, value_states = static_cache.update(self.layer_idx, key_states, value_states)
 
-            if mask is not None:
-                alibi = alibi + mask  # (batch_size, n_heads, seq_length, key_length)
+            attn_bias = mask  # (batch_size, n_heads, seq_length, key_length)
 
-            scores += alibi
+        elif self.position_encoding_type in [POSITION_ENCODING_ALIBI, POSITION_ENCODING_ALIBI_LEARNED]:
+            # the ALiBi bias is already added to the mask, once for all layers, by CustomT5Stack.forward
+            attn_bias = mask  # (batch_size, n_heads, seq_length, key_length)
 
         elif self.position_encoding_type == POSITION_ENCODING_FIRE:
             scores = torch.matmul(query_states, key_states.transpose(3, 2))
             attention_output_dict["scores_before"] = scores
 
-            if position_bias is None:
-                position_bias = self.fire_model(scores)
+            if position_bias is None or isinstance(position_bias, tuple):
+                # (query, key) pairs of CustomT5Stack.forward; the following layers reuse the bias of the first one
+                position_bias = self.fire_model(scores, pairs=position_bias)
 
             if mask is not None:
                 position_bias = position_bias + mask
@@ -511,72 +468,81 @@ class CustomT5Attention(T5Attention):
             scores += position_bias
 
         elif self.position_encoding_type == POSITION_ENCODING_COUPLED_REL_BIAS:
-            scores = torch.matmul(query_states, key_states.transpose(3, 2))
-            attention_output_dict["scores_before"] = scores
-
-            relative_position, attention_mask = position_bias
-            true_seq_len_tensor = (attention_mask==1).sum(-1)  # r(batchsize, )
-            num_buckets = self.relative_attention_num_buckets
-            
-            # Map [-num_buckets//2, ..., 0, ..., num_buckets-1 - num_buckets//2] to [0, ..., num_buckets//2, ..., num_buckets-1]
-            # It is important to consistently map 0 to num_bucekts//2.
-            relative_position_bucket = torch.clip(
-                relative_position + num_buckets//2,
-                torch.tensor(0).to(relative_position.device),
-                torch.tensor(num_buckets-1).to(relative_position.device)
-            ) # shape (..., batchsize, query_length, key_length, num_heads)
+            # bucket indices and sequence lengths are computed once for all layers by CustomT5Stack.forward
+            relative_position_bucket, true_seq_len_tensor = position_bias  # r(..., batchsize, query_length, key_length), r(batchsize, ) or r(batchsize, seqlen)
             if self.position_dim is None:
-                position_bias_rel = self.relative_attention_bias(relative_position_bucket) # shape (batchsize, query_length, key_length, num_heads)
+                position_bias_rel = gather_relative_bias(self.relative_attention_bias.weight, relative_position_bucket) # shape (batchsize, num_heads, query_length, key_length)
             else:
                 # for i in range(self.position_dim):
                 #     print(relative_position_bucket[i,0].cpu().numpy())
                 assert self.position_dim == relative_position_bucket.size(0), f"{self.position_dim} != {relative_position_bucket.size(0)}"
-                position_bias_rel = sum(pe(bucket) for bucket, pe in zip(relative_position_bucket, self.relative_attention_bias)) # shape (batchsize, query_length, key_length, num_heads)
-            position_bias_rel = position_bias_rel.permute([0, 3, 1, 2]) # shape (batchsize, num_heads, query_length, key_length)
+                position_bias_rel = sum(gather_relative_bias(pe.weight, bucket) for bucket, pe in zip(relative_position_bucket, self.relative_attention_bias)) # shape (batchsize, num_heads, query_length, key_length)
 
             # if key and values are already calculated
             # we want only the last query position bias
             if past_key_value is not None:
                 position_bias_rel = position_bias_rel[:, :, -hidden_states.size(1) :, :]
 
+            if self.log_scale_base is not None:
+                log_scaler = torch.log(true_seq_len_tensor) / math.log(self.log_scale_base)
+                if log_scaler.dim() == 1:
+                    log_scaler = log_scaler[:, None, None, None]
+                else:
+                    log_scaler = log_scaler[:, None, :, None]  # length of the segment of each query
+                # log(seq_len) scaling for length generalization (before masking: a scaled mask overflows to -inf,
+                # hence NaN for queries without any visible key, e.g., the left padding of greedy decoding)
+                position_bias_rel = position_bias_rel * log_scaler
+
             if mask is not None:
                 position_bias_rel += mask # (batch_size, n_heads, seq_length, key_length)
-            
-            if self.log_scale_base is None:
-                scores += position_bias_rel
-            else:
-                log_scaler = torch.log(true_seq_len_tensor) / math.log(self.log_scale_base)
-                scores += position_bias_rel * log_scaler[:, None, None, None]  # log(seq_len) scaling for length generalization
+
+            attn_bias = position_bias_rel
         
         else:
-            scores = torch.matmul(
-                query_states, key_states.transpose(3, 2)
-            )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
+            attn_bias = mask  # (batch_size, n_heads, seq_length, key_length)
+
+        if scores is None and self.attention_backend == ATTENTION_BACKEND_SDPA \
+           and not (output_attentions or self.tempered_softmax or layer_head_mask is not None):
+            # fused kernel: the (batch_size, n_heads, seq_length, key_length) scores and probabilities are
+            # never materialized (nor kept for backward). T5 does not scale the scores by 1/sqrt(d_head).
+            attn_output = nn.functional.scaled_dot_product_attention(
+                query_states,
+                key_states,
+                value_states,
+                attn_mask=attn_bias,
+                dropout_p=self.dropout if self.training else 0.0,
+                scale=1.0,
+            )  # (batch_size, n_heads, seq_length, dim_per_head)
+        else:
+            if scores is None:
+                scores = torch.matmul(
+                    query_states, key_states.transpose(3, 2)
+                )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
+                attention_output_dict["scores_before"] = scores
+                if attn_bias is not None:
+                    scores += attn_bias
 
-            if mask is not None:
-                scores += mask  # (batch_size, n_heads, seq_length, key_length)
+            if self.tempered_softmax:
+                scores[scores != float('-inf')] *= 1. + self.tau * torch.log(torch.tensor(seq_length)).to(device=scores.device)
 
-        if self.tempered_softmax:
-            scores[scores != float('-inf')] *= 1. + self.tau * torch.log(torch.tensor(seq_length)).to(device=scores.device)
+            attention_output_dict["scores"] = scores
 
-        attention_output_dict["scores"] = scores
+            attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(
+                scores
+            )  # (batch_size, n_heads, seq_length, key_length)
+            attn_weights = nn.functional.dropout(
+                attn_weights, p=self.dropout, training=self.training
+            )  # (batch_size, n_heads, seq_length, key_length)
 
-        attn_weights = nn.functional.softmax(scores.float(), dim=-1).type_as(
-            scores
-        )  # (batch_size, n_heads, seq_length, key_length)
-        attn_weights = nn.functional.dropout(
-            attn_weights, p=self.dropout, training=self.training
-        )  # (batch_size, n_heads, seq_length, key_length)
+            # Mask heads if we want to
+            if layer_head_mask is not None:
+                attn_weights = attn_weights * layer_head_mask
 
-        # Mask heads if we want to
-        if layer_head_mask is not None:
-            attn_weights = attn_weights * layer_head_mask
+            attention_output_dict["probs"] = attn_weights
 
-        attention_output_dict["probs"] = attn_weights
+            attn_output = torch.matmul(attn_weights, value_states)
 
-        attn_output = unshape(
-            torch.matmul(attn_weights, value_states)
-        )  # (batch_size, seq_length, dim)
+        attn_output = unshape(attn_output)  # (batch_size, seq_length, dim)
         attn_output = self.o(attn_output)
 
         present_key_value_state = (
@@ -954,6 +920,7 @@ class CustomT5Stack(T5Stack):
         output_attentions=None,
         output_hidden_states=None,
         position_ids=None,
+        segment_ids=None,
         return_dict=None,
     ):
         # Model parallel
@@ -991,6 +958,31 @@ class CustomT5Stack(T5Stack):
                 f"You have to specify either {err_msg_prefix}input_ids or {err_msg_prefix}inputs_embeds"
             )
 
+        # With past_key_values, position_ids may also cover the past tokens (incremental decoding with precomputed
+        # coupled positions, see src/evaluate/generation.py); the last ones are those of the current tokens.
+        # With a StaticKVCache, position_ids and attention_mask cover all its slots; the current tokens take the next ones.
+        key_position_ids = None
+        static_cache = past_key_values if isinstance(past_key_values, StaticKVCache) else None
+        if static_cache is not None:
+            if self.position_encoding_type in [
+                POSITION_ENCODING_ROTARY_OLD,
+                POSITION_ENCODING_ROTARY_NEW,
+                POSITION_ENCODING_FIRE,
+                POSITION_ENCODING_REL_TRANSFORMER_XL,
+            ]:
+                raise NotImplementedError(f"StaticKVCache is not supported for {self.position_encoding_type}")
+            device = input_ids.device if input_ids is not None else inputs_embeds.device
+            cache_position = static_cache.advance(input_shape[-1], device)
+            if position_ids is None:
+                position_ids = torch.arange(static_cache.max_length, device=device)
+            if attention_mask is None:
+                attention_mask = torch.ones(input_shape[0], static_cache.max_length, device=device)
+            key_position_ids = position_ids
+            position_ids = position_ids.index_select(-1, cache_position)
+        elif position_ids is not None and past_key_values is not None and position_ids.size(-1) > input_shape[-1]:
+            key_position_ids = position_ids
+            position_ids = position_ids[..., -input_shape[-1]:]
+
         if inputs_embeds is None:
             assert (
                 self.embed_tokens is not None
@@ -1004,8 +996,8 @@ class CustomT5Stack(T5Stack):
             if position_ids is not None and position_ids.dim() <= 2:
                 position_ids = position_ids.view(-1, input_shape[-1])
 
-            if past_key_values is None:
-                past_length = 0
+            if past_key_values is None or static_cache is not None:
+                past_length = 0  # (position_ids are given with a static cache)
             else:
                 past_length = past_key_values[0][0].size(-2)
 
@@ -1031,30 +1023,43 @@ class CustomT5Stack(T5Stack):
         # `position_bias` is a just tensor that is passed to all attention layers
         position_bias = None
 
-        # required mask seq length can be calculated via length of past
-        mask_seq_length = (
-            past_key_values[0][0].shape[2] + seq_length
-            if past_key_values is not None
-            else seq_length
-        )
-
         if use_cache is True:
             assert (
                 self.is_decoder
             ), f"`use_cache` can only be set to `True` if {self} is used as a decoder"
 
         if attention_mask is None:
+            # required mask seq length can be calculated via length of past
+            mask_seq_length = (
+                past_key_values[0][0].shape[2] + seq_length
+                if past_key_values is not None
+                else seq_length
+            )
             attention_mask = torch.ones(batch_size, mask_seq_length).to(
                 inputs_embeds.device
             )
 
+        segment_mask = None
+        if segment_ids is not None:
+            ## Packed rows (see `pack_for_decoder`): a token attends to the earlier tokens of its own segment only ##
+            if self.position_encoding_type == POSITION_ENCODING_FIRE:
+                raise NotImplementedError("packed sequences (segment_ids) are not supported for FIRE")
+            if past_key_values is not None:
+                raise NotImplementedError("packed sequences (segment_ids) are not supported with past_key_values")
+            segment_ids = segment_ids.view(-1, input_shape[-1])
+            segment_mask = segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)  # (batchsize, seqlen, seqlen)
+
+        cache_mask = None
+        if static_cache is not None:
+            cache_mask = static_cache.get_attention_mask(attention_mask)  # (batchsize, seqlen, max_length)
+
         if self.position_encoding_type == POSITION_ENCODING_COUPLED_REL_BIAS \
            or self.position_encoding_type.startswith('rotary_'):
             if position_ids is not None and position_ids.dim() <= 2:
                 position_ids = position_ids.view(-1, input_shape[-1])
 
-            if past_key_values is None:
-                past_length = 0
+            if past_key_values is None or static_cache is not None:
+                past_length = 0  # (position_ids are given with a static cache)
             else:
                 past_length = past_key_values[0][0].size(-2)
 
@@ -1076,48 +1081,67 @@ class CustomT5Stack(T5Stack):
                         
             elif self.position_encoding_type == POSITION_ENCODING_COUPLED_REL_BIAS:
                 ## Relative PE variant of Position Coupling (Cho et al., 2024) ##
-                context_position = position_ids.unsqueeze(-1)  # (..., batchsize, seqlen, 1)
-                memory_position = position_ids.unsqueeze(-2)   # (..., batchsize, 1, seqlen)
+                if past_key_values is not None and key_position_ids is None:
+                    raise ValueError("coupled_relative_bias with past_key_values needs the position_ids of the past tokens as well")
+                if key_position_ids is None:
+                    key_position_ids = position_ids
+                elif key_position_ids.dim() <= 2:
+                    key_position_ids = key_position_ids.view(-1, key_position_ids.size(-1))
+                context_position = position_ids.to(torch.int32).unsqueeze(-1)  # (..., batchsize, seqlen, 1)
+                memory_position = key_position_ids.to(torch.int32).unsqueeze(-2)   # (..., batchsize, 1, key_length)
                 relative_position = memory_position - context_position
-                position_bias = relative_position, attention_mask  # (..., batchsize, seqlen, seqlen)
+
+                # Map [-num_buckets//2, ..., 0, ..., num_buckets-1 - num_buckets//2] to [0, ..., num_buckets//2, ..., num_buckets-1]
+                # It is important to consistently map 0 to num_bucekts//2.
+                # The buckets are shared by all layers, which only gather their own biases (int32: valid embedding indices).
+                num_buckets = self.config.relative_attention_num_buckets
+                relative_position_bucket = relative_position.add_(num_buckets//2).clamp_(0, num_buckets-1)  # (..., batchsize, seqlen, seqlen)
+
+                # length of each sequence for log(seq_len) scaling (or of the segment of each query, for packed rows;
+                # or of the sequence so far, with a static cache)
+                if cache_mask is not None:
+                    true_seq_len_tensor = cache_mask[:, -1].sum(-1)
+                else:
+                    true_seq_len_tensor = ((attention_mask if segment_mask is None else segment_mask)==1).sum(-1)
+                position_bias = relative_position_bucket, true_seq_len_tensor
 
         # initialize past_key_values with `None` if past does not exist
         if past_key_values is None:
             past_key_values = [None] * len(self.block)
+        elif static_cache is not None:
+            past_key_values = [static_cache] * len(self.block)
 
         # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
         # ourselves in which case we just need to make it broadcastable to all heads.
-        extended_attention_mask = self.get_extended_attention_mask(
-            attention_mask, input_shape, inputs_embeds.device
-        )
-
-        if self.position_encoding_type == POSITION_ENCODING_ALIBI:
-            num_heads = self.config.num_heads
-            alibi = build_alibi_tensor(
-                attention_mask, num_heads, dtype=inputs_embeds.dtype
+        if cache_mask is not None:
+            extended_attention_mask = self.get_extended_attention_mask(cache_mask, input_shape, inputs_embeds.device)
+        else:
+            extended_attention_mask = self.get_extended_attention_mask(
+                attention_mask if segment_mask is None else segment_mask.tril(), input_shape, inputs_embeds.device
             )
-            position_bias = alibi
 
-        if self.position_encoding_type in [POSITION_ENCODING_ALIBI_LEARNED]:
-            if not hasattr(self, "alibi"):
-                maxpos = 2048
-                attn_heads = self.config.num_heads
-                slopes = self.learned_logslopes.exp()
-                alibi = slopes.unsqueeze(1).unsqueeze(1) * torch.arange(
-                    maxpos, device=slopes.device
-                ).unsqueeze(0).unsqueeze(0).expand(attn_heads, -1, -1)
-                alibi = alibi.view(attn_heads, 1, maxpos)
+        if self.position_encoding_type in [POSITION_ENCODING_ALIBI, POSITION_ENCODING_ALIBI_LEARNED]:
+            # The ALiBi bias (batch_size or 1, num_heads, 1, key_length) is computed at the current key length and
+            # broadcast-added to the (batch_size, 1, seq_length, key_length) mask once for all layers.
+            num_heads = self.config.num_heads
+            key_length = extended_attention_mask.size(-1)
+            if self.position_encoding_type == POSITION_ENCODING_ALIBI:
+                alibi = build_alibi_tensor(
+                    attention_mask, num_heads, dtype=inputs_embeds.dtype
+                )
+                alibi = alibi.view(-1, num_heads, 1, key_length)
             else:
-                alibi = self.alibi
-
-            alibi = alibi.unsqueeze(0).repeat(batch_size, 1, 1, 1)
-            alibi = alibi[:, :, :, : attention_mask.shape[-1]]
-            alibi = alibi.repeat(1, 1, extended_attention_mask.shape[2], 1)
-            extended_attention_mask = torch.where(
-                extended_attention_mask == 0,
-                alibi,
-                extended_attention_mask.repeat(1, self.config.num_heads, 1, 1),
-            )
+                # slope * key index j rather than slope * -(i-j): a shift by a constant per query, same softmax
+                slopes = self.learned_logslopes.exp()
+                alibi = slopes[:, None] * torch.arange(key_length, device=slopes.device)
+                alibi = alibi.view(1, num_heads, 1, key_length)
+            # (the masked entries, finfo.min, are left unchanged by the bias)
+            extended_attention_mask = extended_attention_mask + alibi
+
+        if self.position_encoding_type == POSITION_ENCODING_FIRE:
+            # the MLP of the FIRE bias is only evaluated over the pairs of nonzero distance (computed once for all layers)
+            key_length = seq_length if past_key_values[0] is None else past_key_values[0][0].size(-2) + seq_length
+            position_bias = FIRE.get_pairs(seq_length, key_length, device=inputs_embeds.device)
 
         # Prepare head mask if needed
         head_mask = self.get_head_mask(head_mask, self.config.num_layers)
@@ -1208,6 +1232,9 @@ class CustomT5Stack(T5Stack):
                     if i == v[-1] and "cuda:" + str(k) != self.last_device:
                         hidden_states = hidden_states.to("cuda:" + str(k + 1))
 
+        if use_cache and static_cache is not None:
+            present_key_value_states = static_cache
+
         hidden_states = self.final_layer_norm(hidden_states)
         hidden_states = self.dropout(hidden_states)
 
@@ -1236,6 +1263,23 @@ class CustomT5Stack(T5Stack):
         )
 
 
+@dataclass
+class TeacherForcedEvalOutput(ModelOutput):
+    """
+    Output of `CustomDecoderOnlyT5.forward_eval`, computed at the label tokens only (labels != -100).
+        loss: mean cross-entropy (as `forward`)
+        token_losses: (n_label_tokens, ) cross-entropy of every label token
+        predictions, targets: (n_label_tokens, ) argmax predictions and labels
+        instance_correct: (n_instances, ) whether all (non-pad) label tokens of an instance (row, or segment of a
+            packed row) are predicted
+    """
+    loss: Optional[torch.FloatTensor] = None
+    token_losses: Optional[torch.FloatTensor] = None
+    predictions: Optional[torch.LongTensor] = None
+    targets: Optional[torch.LongTensor] = None
+    instance_correct: Optional[torch.BoolTensor] = None
+
+
 class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
 
     _keys_to_ignore_on_load_missing = [
@@ -1419,10 +1463,10 @@ class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
     def get_output_embeddings(self):
         return self.lm_head
 
-    def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
-        # only last token for inputs_ids if past is defined in kwargs
-        if past:
-            input_ids = input_ids[:, -1].unsqueeze(-1)
+    def prepare_inputs_for_generation(self, input_ids, past_key_values=None, past=None, **kwargs):
+        # `past` is the name used by older versions of transformers
+        if past_key_values is None:
+            past_key_values = past
 
         attention_mask = kwargs.get("attention_mask", None)
         position_ids = kwargs.get("position_ids", None)
@@ -1431,14 +1475,18 @@ class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 1)
-            if past:
-                position_ids = position_ids[:, -1].unsqueeze(-1)
-        else:
-            position_ids = position_ids[:input_ids.size(-1)]
+        elif position_ids is not None:
+            # precomputed (e.g., coupled) position ids of the whole sequence: keep those of the tokens so far,
+            # past ones included (the stack takes the last ones for the current tokens)
+            position_ids = position_ids[..., :input_ids.size(-1)]
+
+        # only last token for inputs_ids if past is defined in kwargs
+        if past_key_values:
+            input_ids = input_ids[:, -1].unsqueeze(-1)
 
         return {
             "input_ids": input_ids,
-            "past_key_values": past,
+            "past_key_values": past_key_values,
             "use_cache": kwargs.get("use_cache"),
             "attention_mask": attention_mask,
             "position_ids": position_ids,
@@ -1450,6 +1498,7 @@ class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
         past_key_values=None,
         attention_mask=None,
         position_ids=None,
+        segment_ids=None,
         head_mask=None,
         inputs_embeds=None,
         labels=None,
@@ -1478,6 +1527,7 @@ class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
             position_ids=position_ids,
+            segment_ids=segment_ids,
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
@@ -1523,6 +1573,76 @@ class CustomDecoderOnlyT5(T5PreTrainedModel, GenerationMixin):
             attentions=transformer_outputs.attentions,
         )
 
+    @torch.no_grad()
+    def forward_eval(
+        self,
+        input_ids=None,
+        labels=None,
+        attention_mask=None,
+        position_ids=None,
+        segment_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+    ):
+        """
+        Teacher-forced evaluation in one pass: loss, predictions and exact match of every instance.
+        Unlike `forward`, the logits (and their fp32 copy for the loss) are only computed at the label tokens,
+        instead of (batchsize, seqlen, vocab_size).
+        """
+        transformer_outputs = self.decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            inputs_embeds=inputs_embeds,
+            position_ids=position_ids,
+            segment_ids=segment_ids,
+            head_mask=head_mask,
+            use_cache=False,
+            return_dict=True,
+        )
+        hidden_states = transformer_outputs.last_hidden_state
+
+        # Shift so that tokens < n predict n
+        shift_labels = labels[..., 1:]
+        is_label = shift_labels != -100  # (batchsize, seqlen-1)
+        targets = shift_labels[is_label]
+        label_hidden_states = hidden_states[..., :-1, :][is_label]  # (n_label_tokens, d_model)
+
+        if self.config.tie_word_embeddings:
+            # Rescale output before projecting on vocab
+            label_hidden_states = label_hidden_states * (self.model_dim**-0.5)
+
+        logits = self.lm_head(label_hidden_states)  # (n_label_tokens, vocab_size)
+        # Compute loss in fp32 to match with mesh-tf version
+        token_losses = nn.functional.cross_entropy(logits.float(), targets, reduction='none')
+        predictions = logits.argmax(dim=-1)
+
+        # number of wrong (non-pad) label tokens of every row, or of every segment of packed rows
+        n_wrong = (predictions != targets) & (targets != self.config.pad_token_id)
+        rows = torch.arange(len(is_label), device=is_label.device)[:, None].expand_as(is_label)[is_label]
+        if segment_ids is None:
+            n_wrong = torch.zeros(len(is_label), dtype=torch.long, device=is_label.device).index_put_(
+                (rows,), n_wrong.long(), accumulate=True
+            )
+            instance_correct = n_wrong == 0
+        else:
+            segments = segment_ids[..., 1:][is_label]
+            n_wrong = torch.zeros(len(is_label), segment_ids.size(1)+1, dtype=torch.long, device=is_label.device).index_put_(
+                (rows, segments), n_wrong.long(), accumulate=True
+            )
+            # every segment (1, 2, ..., n_segments; 0 for pads) is an instance
+            n_segments = segment_ids.max(dim=1).values
+            is_segment = torch.arange(n_wrong.size(1), device=n_wrong.device)[None, :] <= n_segments[:, None]
+            is_segment[:, 0] = False
+            instance_correct = (n_wrong == 0)[is_segment]
+
+        return TeacherForcedEvalOutput(
+            loss=token_losses.mean().to(hidden_states.dtype),
+            token_losses=token_losses,
+            predictions=predictions,
+            targets=targets,
+            instance_correct=instance_correct,
+        )
+
     @staticmethod
     def _reorder_cache(
         past: Tuple[Tuple[torch.Tensor]], beam_idx: torch.Tensor
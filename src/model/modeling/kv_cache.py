@@ -0,0 +1,51 @@
+import torch
+
+
+class StaticKVCache:
+    """
+    Preallocated keys and values of the self-attention layers, for incremental decoding with
+    CustomDecoderOnlyT5 / CustomGPT2LMHeadModel (passed as `past_key_values`, see src/evaluate/generation.py).
+
+    Every layer has (batch_size, n_heads, max_length, d_kv) key/value buffers, allocated at the first forward.
+    A forward writes the keys/values of its tokens in place at the next slots (`cache_position`), and the queries
+    attend to all the `max_length` slots: those not written yet (or after the query) are masked out. Hence the
+    `position_ids` and `attention_mask` given to the model cover all the slots, and with one new token per step
+    every step has the same shapes (no torch.cat / reallocation; torch.compile-friendly).
+    """
+    def __init__(self, n_layers, max_length):
+        self.max_length = max_length
+        self.keys = [None] * n_layers
+        self.values = [None] * n_layers
+        self.cache_position = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def reset(self):
+        # the slots are written again from the first one (stale ones are masked out until then)
+        self.cache_position = None
+
+    def advance(self, query_length, device=None):
+        # slots of the next query_length tokens: (query_length, )
+        if self.cache_position is None:
+            self.cache_position = torch.arange(query_length, device=device)
+        else:
+            self.cache_position = self.cache_position[-1:] + torch.arange(1, query_length + 1, device=device)
+        return self.cache_position
+
+    def get_attention_mask(self, attention_mask):
+        # attention_mask: (batch_size, max_length) -> (batch_size, query_length, max_length),
+        # a query attends to the (non-pad) slots up to its own
+        slots = torch.arange(self.max_length, device=self.cache_position.device)
+        return (attention_mask[:, None, :] == 1) & (slots <= self.cache_position[:, None])
+
+    def update(self, layer_idx, key_states, value_states):
+        # key_states, value_states: (batch_size, n_heads, query_length, d_kv) of the current tokens
+        # returns the buffers of the layer: (batch_size, n_heads, max_length, d_kv)
+        if self.keys[layer_idx] is None:
+            batch_size, n_heads = key_states.shape[:2]
+            self.keys[layer_idx] = key_states.new_zeros(batch_size, n_heads, self.max_length, key_states.size(-1))
+            self.values[layer_idx] = value_states.new_zeros(batch_size, n_heads, self.max_length, value_states.size(-1))
+        self.keys[layer_idx].index_copy_(2, self.cache_position, key_states)
+        self.values[layer_idx].index_copy_(2, self.cache_position, value_states)
+        return self.keys[layer_idx], self.values[layer_idx]
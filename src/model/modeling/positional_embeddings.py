@@ -165,6 +165,35 @@ def apply_rotary_pos_emb(q, k, cos, sin, unsqueeze_dim=1):
     k_embed = (k * cos) + (rotate_half(k) * sin)
     return q_embed, k_embed
 
+
+def apply_partial_rotary_pos_emb(x, cos, sin, rotary_dim=None, interleaved=False):
+    """
+    Rotates the first `rotary_dim` features of x (batch_size, n_heads, seq_length, d_head) in a single output
+    tensor, the other features being copied as is: no `rotate_half`/`rotate_every_two` copies, `torch.cat` or permutes.
+    Equal to `apply_rotary_pos_emb` (interleaved=False, features i and i + rotary_dim // 2 rotated together)
+    and to `apply_rotary_pos_emb_old`/`_new` (interleaved=True, features 2i and 2i + 1 rotated together).
+    cos, sin: angles of the rotary_dim // 2 feature pairs, broadcastable to (batch_size, n_heads, seq_length, rotary_dim // 2)
+    """
+    if rotary_dim is None:
+        rotary_dim = x.size(-1)
+    if interleaved:
+        idx1, idx2 = slice(0, rotary_dim, 2), slice(1, rotary_dim, 2)
+    else:
+        idx1, idx2 = slice(0, rotary_dim // 2), slice(rotary_dim // 2, rotary_dim)
+    x1, x2 = x[..., idx1], x[..., idx2]
+    out = torch.empty_like(x)
+    requires_grad = torch.is_grad_enabled() and (x.requires_grad or cos.requires_grad or sin.requires_grad)
+    if requires_grad or torch.compiler.is_compiling():  # (fused into a single kernel by torch.compile)
+        out[..., idx1] = x1 * cos - x2 * sin
+        out[..., idx2] = x2 * cos + x1 * sin
+    else:
+        # written in place (`out=` is not differentiable)
+        torch.mul(x1, cos, out=out[..., idx1]).sub_(x2 * sin)
+        torch.mul(x2, cos, out=out[..., idx2]).add_(x1 * sin)
+    if rotary_dim < x.size(-1):
+        out[..., rotary_dim:] = x[..., rotary_dim:]
+    return out
+
 def get_inv_freq_for_hierarchical_rope(inv_freq, d_positions, config):
     division_ratios = list(getattr(config, 'division_ratios', [(i+1)/d_positions for i in range(d_positions)]))
     rotary_dim_half = inv_freq.shape[0]
@@ -190,7 +219,14 @@ ROPE_MULTIPOS_FUNCTIONS = {
 }
 
 class RotaryEmbedding(nn.Module):
-    """Brought from `transformers.models.llama.LlamaRotaryEmbedding`."""
+    """
+    Brought from `transformers.models.llama.LlamaRotaryEmbedding`.
+    The (integer) position ids are bounded by `config.n_positions` (times `config.pid_multiplier` if any), so the
+    cos/sin of all of them are computed once (float32, per device) and `forward` gathers them by position id.
+    With multi-dimensional position ids (`d_positions`, HiRoPE/multi-RoPE), the angles of every dimension are
+    tabulated instead, and `forward` sums the gathered angles before taking cos/sin.
+    The tables are rebuilt whenever `inv_freq` changes (`dynamic` rope type).
+    """
     def __init__(
         self,
         rope_type="default",
@@ -218,6 +254,27 @@ class RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)  # (rope_dim,) where rope_dim = int(config.head_dim * config.partial_rotary_factor)
         self.original_inv_freq = self.inv_freq
 
+        self.max_position = config.n_positions * int(getattr(config, 'pid_multiplier', None) or 1)
+        self._reset_tables()
+
+    def _reset_tables(self):
+        # plain attributes rather than buffers: they stay float32 whatever the dtype of the model
+        self._cos_cached = None  # (max_position, rope_dim)
+        self._sin_cached = None
+        self._freqs_cached = None  # (d_positions, max_position, rope_dim // 2)
+
+    def _build_tables(self, device):
+        length = max(self.max_position, self.max_seq_len_cached)
+        positions = torch.arange(length, device=device, dtype=torch.float32)
+        inv_freq = self.inv_freq.to(device=device, dtype=torch.float32)
+        if self.d_positions is None:
+            freqs = positions[:, None] * inv_freq[None, :]  # outer product
+            emb = torch.cat((freqs, freqs), dim=-1)
+            self._cos_cached = emb.cos() * self.attention_scaling
+            self._sin_cached = emb.sin() * self.attention_scaling
+        else:
+            self._freqs_cached = positions[None, :, None] * inv_freq[:, None, :]
+
     def _dynamic_frequency_update(self, position_ids, device):
         """
         dynamic RoPE layers should recompute `inv_freq` in the following situations:
@@ -234,10 +291,12 @@ class RotaryEmbedding(nn.Module):
                 inv_freq = self.rope_multipos_fn(inv_freq, self.d_positions, self.config)
             self.register_buffer("inv_freq", inv_freq, persistent=False)  # TODO joao: may break with compilation
             self.max_seq_len_cached = seq_len
+            self._reset_tables()
 
         if seq_len < self.original_max_seq_len and self.max_seq_len_cached > self.original_max_seq_len:  # reset
             self.register_buffer("inv_freq", self.original_inv_freq, persistent=False)
             self.max_seq_len_cached = self.original_max_seq_len
+            self._reset_tables()
 
     @torch.no_grad()
     def forward(self, position_ids):
@@ -245,30 +304,22 @@ class RotaryEmbedding(nn.Module):
         if "dynamic" in self.rope_type:
             self._dynamic_frequency_update(position_ids, device=device)
 
-        # Core RoPE block
-        batchsize = position_ids.shape[-2]
+        # Core RoPE block: tables in float32 (see https://github.com/huggingface/transformers/pull/29285)
+        table = self._cos_cached if self.d_positions is None else self._freqs_cached
+        if table is None or table.device != device:
+            self._build_tables(device)
+        position_ids = position_ids.long()
         if self.d_positions is None:
-            inv_freq_expanded = self.inv_freq[None, :, None].float().to(device).expand(batchsize, -1, 1)
-            position_ids_expanded = position_ids[:, None, :].float()
-        else:
-            inv_freq_expanded = self.inv_freq[:, None, :, None].float().to(device).expand(-1, batchsize, -1, 1)
-            position_ids_expanded = position_ids[:, :, None, :].float()
-        # Force float32 (see https://github.com/huggingface/transformers/pull/29285)
-        device_type = device.type
-        device_type = device_type if isinstance(device_type, str) and device_type != "mps" else "cpu"
-        with torch.autocast(device_type=device_type, enabled=False):
-            freqs = (inv_freq_expanded.float() @ position_ids_expanded.float()).transpose(-2, -1)  # outer product
-            if self.d_positions is not None:
-                assert freqs.ndim == 4
-                freqs = freqs.sum(0)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos()
-            sin = emb.sin()
-
-        # Advanced RoPE types (e.g. yarn) apply a post-processing scaling factor, equivalent to scaling attention
-        cos = cos * self.attention_scaling
-        sin = sin * self.attention_scaling
-
+            # Advanced RoPE types (e.g. yarn) apply a post-processing scaling factor, equivalent to scaling attention
+            # (already applied to the tables)
+            return self._cos_cached[position_ids], self._sin_cached[position_ids]
+
+        assert position_ids.ndim == 3  # (d_positions, batch_size, seq_len)
+        dims = torch.arange(position_ids.size(0), device=device)[:, None, None]
+        freqs = self._freqs_cached[dims, position_ids].sum(0)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        cos = emb.cos() * self.attention_scaling
+        sin = emb.sin() * self.attention_scaling
         return cos, sin
     
 
@@ -329,6 +380,53 @@ def build_alibi_tensor(
     return alibi.reshape(batch_size * num_heads, 1, seq_length).to(dtype)
 
 
+class RelativeBiasGather(torch.autograd.Function):
+    """
+    Relative bias lookup `bias[b, h, i, j] = weight[bucket[b, i, j], h]` for the coupled relative bias.
+    Since the table (num_buckets, num_heads) is tiny, the bias is gathered from its transpose directly
+    in the (batch_size, num_heads, query_length, key_length) layout, instead of an nn.Embedding lookup
+    of shape (batch_size, query_length, key_length, num_heads) followed by a permute.
+    The backward scatter-adds the gradient into the table (one bincount per head), instead of the
+    embedding backward which sorts all the batch_size*query_length*key_length indices. bincount is not
+    deterministic on CUDA, so with `torch.use_deterministic_algorithms` (see `set_seed`) the gradient is
+    accumulated with index_put_ instead, which is.
+    """
+    @staticmethod
+    def forward(ctx, weight, bucket):
+        # weight: (num_buckets, num_heads), bucket: (batch_size, query_length, key_length) integer
+        table = weight.t().contiguous()  # (num_heads, num_buckets)
+        batch_size, query_length, key_length = bucket.shape
+        num_heads = table.size(0)
+        # (batch_size, num_heads, query_length, key_length) laid out as (num_heads, batch_size, ...) in memory,
+        # so that a single index_select over all the buckets writes it
+        bias = table.new_empty(num_heads, batch_size, query_length, key_length).transpose(0, 1)
+        bias = torch.empty_strided(bias.shape, bias.stride(), dtype=table.dtype, device=table.device)
+        torch.index_select(table, 1, bucket.reshape(-1), out=bias.transpose(0, 1).view(num_heads, -1))
+        ctx.save_for_backward(bucket)
+        ctx.num_buckets = weight.size(0)
+        return bias
+
+    @staticmethod
+    def backward(ctx, grad_bias):
+        bucket, = ctx.saved_tensors
+        index = bucket.reshape(-1)
+        num_heads = grad_bias.size(1)
+        if torch.are_deterministic_algorithms_enabled():
+            values = grad_bias.permute(0, 2, 3, 1).reshape(-1, num_heads)
+            grad_weight = grad_bias.new_zeros(ctx.num_buckets, num_heads).index_put_((index,), values, accumulate=True)
+            return grad_weight, None
+        grad_weight = torch.stack([
+            torch.bincount(index, weights=grad_bias[:, h].reshape(-1), minlength=ctx.num_buckets)
+            for h in range(num_heads)
+        ], dim=-1)
+        return grad_weight.to(grad_bias.dtype), None
+
+
+def gather_relative_bias(weight, bucket):
+    # (num_buckets, num_heads) table, (batch_size, query_length, key_length) buckets -> (batch_size, num_heads, query_length, key_length)
+    return RelativeBiasGather.apply(weight, bucket)
+
+
 class FIRE(nn.Module):
     def __init__(self, num_heads, mlp_hidden, c0=0.1, L0_sqrt=16., eps=1e-6):
         super().__init__()
@@ -350,10 +448,24 @@ class FIRE(nn.Module):
         self.cached_matrix = None
         self.cached_seq_len = None
 
-    def forward(self, x: torch.Tensor, q_pos=None, k_pos=None):
+    @staticmethod
+    def get_pairs(query_length, key_length, device=None):
+        """
+        The (query i, key j) pairs of the bias with a nonzero distance max{i-j, 0}, i.e. i > j (positions 0, 1, ...):
+        the others have a normalized distance of 0, mapped to 0 by the (bias-free) MLP.
+        Returns query_idx, key_idx, rel_distance (i-j), rel_distance_max (i), each of shape (n_pairs, )
+        """
+        query_idx, key_idx = torch.tril_indices(query_length, key_length, offset=-1, device=device)
+        return query_idx, key_idx, (query_idx - key_idx).float(), query_idx.float()
+
+    def forward(self, x: torch.Tensor, q_pos=None, k_pos=None, pairs=None):
         # x : (batch_size, n_heads, query_length, key_length)
         # q_pos : (batch_size, query_length)
         # k_pos : (batch_size, key_length)
+        # pairs : `FIRE.get_pairs(query_length, key_length)`, to evaluate the MLP over those pairs only
+        if pairs is not None:
+            return self._forward_pairs(x, pairs)
+
         seq_len_q = x.size(-2)
         seq_len_k = x.size(-1)
         
@@ -380,3 +492,20 @@ class FIRE(nn.Module):
         position_bias = self.net(normalized_distance.unsqueeze(-1)) # (batch_size, query_length, key_length, num_heads)
 
         return position_bias.permute([0, 3, 1, 2]) # (batch_size, num_heads, query_length, key_length, num_heads)
+
+    def _forward_pairs(self, x, pairs):
+        query_idx, key_idx, rel_distance, rel_distance_max = pairs
+        query_length, key_length = x.size(-2), x.size(-1)
+        rel_distance = rel_distance.type_as(x)  # (n_pairs, )
+        rel_distance_max = rel_distance_max.type_as(x).clamp_max(self.L_sqrt.square())  # max{L, i}
+
+        rel_distance = torch.log(torch.abs(self.c * rel_distance) + 1)
+        rel_distance_max = torch.log(torch.abs(self.c * rel_distance_max) + 1)
+        normalized_distance = rel_distance / (rel_distance_max + self.eps)
+        position_bias = self.net(normalized_distance.unsqueeze(-1))  # (n_pairs, num_heads)
+
+        # scattered into the (query_length, key_length) grid, zero elsewhere
+        position_bias = position_bias.new_zeros(query_length * key_length, self.num_heads).index_copy(
+            0, query_idx * key_length + key_idx, position_bias
+        )
+        return position_bias.view(1, query_length, key_length, self.num_heads).permute([0, 3, 1, 2])  # (1, num_heads, query_length, key_length)
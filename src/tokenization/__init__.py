@@ -1 +1 @@
-from .tokenization import build_tokenizer, tokenize_for_decoder, tokenize_for_encoder_decoder, BINARY_OPS, SpecialToken
\ No newline at end of file
+from .tokenization import build_tokenizer, tokenize_for_decoder, tokenize_for_encoder_decoder, pad_for_decoder, pack_for_decoder, BINARY_OPS, SpecialToken
\ No newline at end of file
@@ -1,3 +1,5 @@
+from itertools import chain
+
 from tokenizers import Tokenizer, pre_tokenizers
 from tokenizers.models import WordLevel
 from tokenizers.pre_tokenizers import Whitespace
@@ -86,6 +88,116 @@ def tokenize_for_encoder_decoder(tokenizer, inputs, labels=None, input_positions
     return out
 
 
+## Table-driven encoder ##
+# The default vocabularies only contain single-character words (digits, symbols, '='), 
+# so a batch of space-separated strings can be encoded with a 256-entry byte lookup table
+# instead of going through `tokenizer.encode_batch`.
+def build_byte_lut(tokenizer):
+    special_tokens = {SpecialToken.pad, SpecialToken.unk, SpecialToken.bos, SpecialToken.eos}
+    words = {w: i for w, i in tokenizer.get_vocab().items() if w not in special_tokens}
+    lut = np.full(256, -1, dtype=np.int64)
+    for word, idx in words.items():
+        if len(word) == 1 and ord(word) < 128 and not word.isspace():
+            lut[ord(word)] = idx
+    for word in words:
+        # a multi-character word is harmless as long as one of its characters is missing from
+        # the table (e.g., 'copy'), since such strings fall back to the HF tokenizer.
+        if len(word) > 1 and all(ord(c) < 128 and lut[ord(c)] >= 0 for c in word):
+            return None  # e.g., index hints '10', '11', ...: use the HF tokenizer
+    return lut
+
+
+def get_byte_lut(tokenizer):
+    if not hasattr(tokenizer, 'byte_lut'):
+        tokenizer.byte_lut = build_byte_lut(tokenizer)
+    return tokenizer.byte_lut
+
+
+def encode_ascii(lut, seqs):
+    """
+    Encode strings / byte strings / uint8 arrays of ASCII codes with a byte lookup table.
+    White spaces are skipped. Returns (flat token ids, lengths), or None if a character
+    is missing from the table or if a word has several characters (e.g., '10': the HF
+    tokenizer maps it to a single word id, or [UNK]).
+    """
+    if isinstance(seqs[0], np.ndarray):
+        codes = np.concatenate([np.append(seq, 10).astype(np.uint8) for seq in seqs])
+    else:
+        if isinstance(seqs[0], str):
+            try:
+                seqs = [seq.encode('ascii') for seq in seqs]
+            except UnicodeEncodeError:
+                return None
+        codes = np.frombuffer(b'\n'.join(seqs) + b'\n', dtype=np.uint8)
+    in_word = (codes != ord(' ')) & (codes != ord('\n'))
+    if np.any(in_word[1:] & in_word[:-1]):
+        return None
+    codes = codes[codes != ord(' ')]
+    is_newline = codes == ord('\n')
+    lengths = np.diff(np.flatnonzero(is_newline), prepend=-1) - 1
+    ids = lut[codes[~is_newline]]
+    if np.any(ids < 0):
+        return None
+    return ids, lengths
+
+
+def scatter_ragged(out, values, lengths, col_offsets):
+    # out[..., b, col_offsets[b] + j] = j-th value of row b (values are the rows concatenated on the last axis)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(values.shape[-1]) - np.repeat(np.cumsum(lengths) - lengths - col_offsets, lengths)
+    out[..., rows, cols] = values
+
+
+def flatten_positions(input_positions, label_positions):
+    # ragged per-example positions ((L,) or (d, L) lists/arrays) -> flat (..., sum(L)) array and lengths
+    pairs = list(zip(input_positions, label_positions))
+    if isinstance(input_positions[0], np.ndarray):
+        lengths = np.array([inp.shape[-1] + lab.shape[-1] for inp, lab in pairs])
+        return np.concatenate([pos for pair in pairs for pos in pair], axis=-1), lengths
+    multi_dim = len(input_positions[0]) > 0 and not np.isscalar(input_positions[0][0])
+    if not multi_dim:
+        lengths = np.array([len(inp) + len(lab) for inp, lab in pairs])
+        return np.fromiter(chain.from_iterable(chain.from_iterable(pairs)), dtype=np.int64, count=lengths.sum()), lengths
+    lengths = np.array([len(inp[0]) + len(lab[0]) for inp, lab in pairs])
+    positions = np.stack([
+        np.fromiter(chain.from_iterable(pos for pair in pairs for pos in (pair[0][d], pair[1][d])), dtype=np.int64, count=lengths.sum())
+        for d in range(len(input_positions[0]))
+    ])
+    return positions, lengths
+
+
+def _fast_encode_for_decoder(tokenizer, inputs, labels):
+    # "[BOS] {inp} = {lab} [EOS]" without calling the HF tokenizer; None if not applicable
+    lut = get_byte_lut(tokenizer)
+    if lut is None:
+        return None
+    encoded_inputs = encode_ascii(lut, inputs)
+    encoded_labels = encode_ascii(lut, labels)
+    if encoded_inputs is None or encoded_labels is None:
+        return None
+    (input_ids, input_lengths), (label_ids, label_lengths) = encoded_inputs, encoded_labels
+    pad_token_id = tokenizer.token_to_id(SpecialToken.pad)
+    eos = tokenizer.eos_token == SpecialToken.eos
+
+    prompt_lengths = input_lengths + 2  # [BOS] {inp} =
+    lengths = prompt_lengths + label_lengths + int(eos)
+    batchsize = len(lengths)
+    total_length = max(lengths.max(), (tokenizer.padding or {}).get('length') or 0)
+    ids = np.full((batchsize, total_length), pad_token_id, dtype=np.int64)
+    rows = np.arange(batchsize)
+    ids[:, 0] = tokenizer.bos_token_id
+    scatter_ragged(ids, input_ids, input_lengths, 1)
+    ids[rows, input_lengths + 1] = tokenizer.token_to_id('=')
+    scatter_ragged(ids, label_ids, label_lengths, prompt_lengths)
+    if eos:
+        ids[rows, lengths - 1] = tokenizer.eos_token_id
+
+    # labels: it is -100 except for the label part of the sequence.
+    is_label = np.arange(total_length)[None, :] >= prompt_lengths[:, None]
+    labels = np.where(np.logical_and(is_label, ids != pad_token_id), ids, -100)
+    return ids, labels
+
+
 ## Batch-Tokenization Function (collator) - decoder ##
 def tokenize_for_decoder(
         tokenizer: Tokenizer, 
@@ -99,67 +211,168 @@ def tokenize_for_decoder(
     pad_token_id = tokenizer.token_to_id(SpecialToken.pad)
 
     out = {}
-    concat = [f"{inp} = {lab}" for inp, lab in zip(inputs, labels)]
+    encoded = _fast_encode_for_decoder(tokenizer, inputs, labels)
+    if encoded is not None:
+        out['input_ids'], out['labels'] = encoded
+    else:
+        concat = [f"{inp} = {lab}" for inp, lab in zip(inputs, labels)]
+        out['input_ids'] = np.array([enc.ids for enc in tokenizer.encode_batch(concat)])
+
+        # labels: it is -100 except for the label part of the sequence.
+        # "tokenizer.eos_token == SpecialToken.eos" is equivalent to "cfg.task.eos == True"
+        concat_inputs = [
+            f"{inp}" + ("" if tokenizer.eos_token==SpecialToken.eos else " =") 
+            for inp in inputs
+        ]
+        input_ids = np.array([enc.ids for enc in tokenizer.encode_batch(concat_inputs)]) # enc.ids includes EOS tokens
+        padded_input_ids = np.concatenate(
+            [input_ids, 
+             np.full((input_ids.shape[0], out['input_ids'].shape[1]-input_ids.shape[1]),
+                     pad_token_id)], 
+            1
+        )
+        out['labels'] = np.where(
+            np.logical_or(out['input_ids'] == pad_token_id, padded_input_ids != pad_token_id),
+            -100,
+            out['input_ids']
+        )
+
+    # attention mask: 0 if out['input_ids'] == pad_token_id, otherwise 1
+    out['attention_mask'] = np.where(out['input_ids'] != pad_token_id, 1, 0)
+
+    # position_ids: (batchsize, total_length) or (d_positions, batchsize, total_length), 0 for [BOS] and pads
+    if input_positions is not None and label_positions is not None:
+        positions, lengths = flatten_positions(input_positions, label_positions)
+        out['position_ids'] = np.zeros(positions.shape[:-1] + out['input_ids'].shape, dtype=np.int64)
+        scatter_ragged(out['position_ids'], positions, lengths, 1)
+
+    if arr_type == 'torch':
+        # torch Tensor
+        for k in out:
+            out[k] = torch.LongTensor(out[k]).to(device)
+    
+    return out
 
-    # print(f"[DEBUG] concat[0]: {concat[0]}")
 
-    out['input_ids'] = np.array([enc.ids for enc in tokenizer.encode_batch(concat)])
+## Collator for pre-tokenized sequences (see src/data/cache.py) - decoder ##
+def pad_for_decoder(
+        tokenizer: Tokenizer,
+        input_ids,
+        prompt_lengths,
+        position_ids=None,
+        arr_type='torch',
+        device='cpu',
+    ):
+    pad_token_id = tokenizer.token_to_id(SpecialToken.pad)
+    lengths = np.array([len(ids) for ids in input_ids])
+    batchsize = len(lengths)
+    total_length = max(lengths.max(), (tokenizer.padding or {}).get('length') or 0)
+    keep = np.arange(total_length)[None, :] < lengths[:, None]
 
-    # print(f"[DEBUG] encoded batch[0]: {tokenizer.encode_batch(concat)[0]}")
+    out = {}
+    out['input_ids'] = np.full((batchsize, total_length), pad_token_id, dtype=np.int64)
+    out['input_ids'][keep] = np.concatenate(input_ids)
 
     # labels: it is -100 except for the label part of the sequence.
-    # "tokenizer.eos_token == SpecialToken.eos" is equivalent to "cfg.task.eos == True"
-    concat_inputs = [
-        f"{inp}" + ("" if tokenizer.eos_token==SpecialToken.eos else " =") 
-        for inp in inputs
-    ]
-    input_ids = np.array([enc.ids for enc in tokenizer.encode_batch(concat_inputs)]) # enc.ids includes EOS tokens
-    padded_input_ids = np.concatenate(
-        [input_ids, 
-         np.full((input_ids.shape[0], out['input_ids'].shape[1]-input_ids.shape[1]),
-                 pad_token_id)], 
-        1
-    )
+    is_label = np.arange(total_length)[None, :] >= np.array(prompt_lengths)[:, None]
     out['labels'] = np.where(
-        np.logical_or(out['input_ids'] == pad_token_id, padded_input_ids != pad_token_id),
-        -100,
-        out['input_ids']
+        np.logical_and(is_label, out['input_ids'] != pad_token_id),
+        out['input_ids'],
+        -100
     )
 
     # attention mask: 0 if out['input_ids'] == pad_token_id, otherwise 1
     out['attention_mask'] = np.where(out['input_ids'] != pad_token_id, 1, 0)
 
     # position_ids
-    if input_positions is not None and label_positions is not None:
-        batchsize, total_length = out['input_ids'].shape
-        if np.array(input_positions[0]).ndim == 1:
-            position_ids = np.zeros((batchsize, total_length), dtype=int)
-            for b, (inp_pos, lab_pos) in enumerate(zip(input_positions, label_positions)):
-                pos = inp_pos + lab_pos
-
-                # print(f"===== INP_POS: {inp_pos}, (len {len(inp_pos)})")
-                # print(f"===== LAB_POS: {lab_pos}, (len {len(lab_pos)})")
-
-                # print(f"\x1b[34mTOKENIZATION: {pos=} (len {len(pos)}), {position_ids=} (shape {position_ids.shape})\x1b[0m")
-
-                position_ids[b, 1:1+len(pos)] = np.array(pos, dtype=int)
-        elif np.array(input_positions[0]).ndim == 2:  # multi dimensional position ids
-            position_id_dim = len(input_positions[0])
-            position_ids = np.zeros((position_id_dim, batchsize, total_length), dtype=int)
-            for b, (inp_positions, lab_positions) in enumerate(zip(input_positions, label_positions)):
-                for d, (inp_pos, lab_pos) in enumerate(zip(inp_positions, lab_positions)):
-                    pos = inp_pos + lab_pos
-                    position_ids[d, b, 1:1+len(pos)] = np.array(pos, dtype=int)
-        out['position_ids'] = position_ids
+    if position_ids is not None and position_ids[0] is not None:
+        lengths = np.array([pos.shape[-1] for pos in position_ids])
+        position_ids = np.concatenate(position_ids, axis=-1)
+        out['position_ids'] = np.zeros(position_ids.shape[:-1] + out['input_ids'].shape, dtype=np.int64)
+        scatter_ragged(out['position_ids'], position_ids, lengths, 0)
 
     if arr_type == 'torch':
         # torch Tensor
         for k in out:
             out[k] = torch.LongTensor(out[k]).to(device)
-    
+
     return out
 
 
+def first_fit_decreasing(lengths, capacity):
+    # bin of every item: longest items first, each into the first bin with enough room left
+    bins = np.zeros(len(lengths), dtype=np.int64)
+    room = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        length = lengths[i]
+        for b, left in enumerate(room):
+            if length <= left:
+                break
+        else:
+            b = len(room)
+            room.append(capacity)
+        room[b] -= length
+        bins[i] = b
+    return bins, len(room)
+
+
+## Sequence packing (collator output -> packed rows) - decoder ##
+def pack_for_decoder(
+        tokenizer: Tokenizer,
+        out,
+        pack_length,
+        arr_type='torch',
+        device='cpu',
+    ):
+    """
+    Pack the (numpy) output of `tokenize_for_decoder` / `pad_for_decoder` into rows of
+    `pack_length` tokens, each holding several examples. Every example keeps its own
+    position_ids (0, 1, 2, ... if there are none), and `segment_ids` tells the examples
+    of a row apart (1, 2, ... in order; 0 for pads): see `CustomT5Stack.forward`.
+    Labels are left as they are, so the loss only covers the label part of each example.
+    """
+    pad_token_id = tokenizer.token_to_id(SpecialToken.pad)
+    lengths = out['attention_mask'].sum(-1)
+    if lengths.max() > pack_length:
+        raise ValueError(f"pack_length={pack_length} is smaller than the longest example ({lengths.max()} tokens)")
+    rows, n_rows = first_fit_decreasing(lengths, pack_length)
+
+    # offset and segment id of every example in its row (examples of a row keep the batch order)
+    order = np.argsort(rows, kind='stable')
+    first = np.searchsorted(rows[order], rows[order])  # first example of the same row
+    starts = np.cumsum(lengths[order]) - lengths[order]
+    offsets, segments = np.empty_like(lengths), np.empty_like(lengths)
+    offsets[order] = starts - starts[first]
+    segments[order] = np.arange(len(lengths)) - first + 1
+
+    src_rows = np.repeat(np.arange(len(lengths)), lengths)
+    src_cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    dst_rows = rows[src_rows]
+    dst_cols = offsets[src_rows] + src_cols
+
+    packed = {}
+    packed['input_ids'] = np.full((n_rows, pack_length), pad_token_id, dtype=np.int64)
+    packed['input_ids'][dst_rows, dst_cols] = out['input_ids'][src_rows, src_cols]
+    packed['labels'] = np.full((n_rows, pack_length), -100, dtype=np.int64)
+    packed['labels'][dst_rows, dst_cols] = out['labels'][src_rows, src_cols]
+    packed['attention_mask'] = np.where(packed['input_ids'] != pad_token_id, 1, 0)
+    packed['segment_ids'] = np.zeros((n_rows, pack_length), dtype=np.int64)
+    packed['segment_ids'][dst_rows, dst_cols] = segments[src_rows]
+    if 'position_ids' in out:
+        position_ids = out['position_ids'][..., src_rows, src_cols]
+    else:
+        position_ids = src_cols
+    packed['position_ids'] = np.zeros(position_ids.shape[:-1] + (n_rows, pack_length), dtype=np.int64)
+    packed['position_ids'][..., dst_rows, dst_cols] = position_ids
+
+    if arr_type == 'torch':
+        # torch Tensor
+        for k in packed:
+            packed[k] = torch.LongTensor(packed[k]).to(device)
+
+    return packed
+
+
 if __name__ == "__main__":
     from dotmap import DotMap
 
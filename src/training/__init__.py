@@ -4,6 +4,12 @@ import torch
 
 
 from .optimization import get_custom_cosine_schedule_with_warmup, get_custom_linear_schedule_with_warmup
+from .metrics import RunningMetrics
+from .microbatch import split_microbatches
+from .checkpoint import (
+    save_checkpoint, load_checkpoint, find_latest_checkpoint, get_checkpoint_path, get_rng_state, set_rng_state,
+    CheckpointWriter,
+)
 
 def set_seed(seed: int, device_type='cuda'):
     """
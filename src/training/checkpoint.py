@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import glob
+import os
+import random
+import re
+from time import perf_counter
+
+import numpy as np
+import torch
+
+
+################ Resumable Checkpoints ################
+# `training.checkpoint_every_steps`: run.py periodically saves the full training state (model, optimizer,
+# LR scheduler, grad scaler, RNG states, position in the training data and the logged metrics so far) to
+# checkpoint_{step}.pt in the logging directory of the run, and `resume=auto` continues from the latest one.
+# The files are written by `CheckpointWriter`, in the background.
+
+STEP_PATTERN = re.compile(r"^(.*)_(\d+)\.pt$")
+
+
+def get_checkpoint_path(logging_path, step, prefix="checkpoint"):
+    return os.path.join(logging_path, f"{prefix}_{step}.pt")
+
+
+def list_checkpoints(logging_path, prefix="checkpoint"):
+    # paths of the {prefix}_{step}.pt files of a logging directory, sorted by training step
+    checkpoints = []
+    for path in glob.glob(os.path.join(glob.escape(logging_path), f"{glob.escape(prefix)}_*.pt")):
+        match = STEP_PATTERN.match(os.path.basename(path))
+        if match is not None and match.group(1) == prefix:
+            checkpoints.append((int(match.group(2)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def find_latest_checkpoint(logging_path):
+    checkpoints = list_checkpoints(logging_path)
+    return checkpoints[-1] if checkpoints else None
+
+
+def get_rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(state, path, keep=None, alias=None):
+    """
+    Save a training state (a dict of state_dicts, tensors and python objects) to `path`.
+    The file is written under a temporary name and renamed, so a job killed while saving never leaves a
+    truncated checkpoint behind. With `keep`, only the `keep` latest {prefix}_{step}.pt files of the directory
+    (path: {prefix}_{step}.pt) are kept. `alias`: another path of the file (hard link, or copy), e.g., best_{model}.pt.
+    """
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    if alias is not None:
+        tmp_alias = alias + ".tmp"
+        if os.path.exists(tmp_alias):
+            os.remove(tmp_alias)
+        try:
+            os.link(path, tmp_alias)
+        except OSError:
+            torch.save(state, tmp_alias)
+        os.replace(tmp_alias, alias)
+    if keep is not None:
+        match = STEP_PATTERN.match(os.path.basename(path))
+        if match is None:
+            raise ValueError(f"keep={keep} needs a {{prefix}}_{{step}}.pt path, got {path}")
+        for old_path in list_checkpoints(os.path.dirname(path), prefix=match.group(1))[:-keep]:
+            os.remove(old_path)
+
+
+def load_checkpoint(path):
+    # (the RNG states are numpy/python objects: not loadable with weights_only=True)
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def snapshot(obj, pin_memory=False):
+    # copy of a (nested) state: tensors copied to the CPU (non-blocking, into pinned memory with pin_memory),
+    # containers rebuilt, and other objects deep-copied, so that training may go on modifying the original
+    if torch.is_tensor(obj):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        buffer = torch.empty(obj.shape, dtype=obj.dtype, device='cpu', pin_memory=pin_memory)
+        return buffer.copy_(obj.detach(), non_blocking=pin_memory)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v, pin_memory)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(snapshot(v, pin_memory) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints (`save_checkpoint`) on a background thread.
+    `save()` only snapshots the state (`snapshot`; from the GPU, an asynchronous copy to pinned memory) and returns,
+    while the serialization and the writing go on in the background, in the order of the `save()` calls.
+    At most `max_pending` writes are queued: a `save()` beyond that waits for the oldest one (bounding the host memory
+    used by the snapshots). An error of a background write is raised by the next `save()` / `close()`.
+
+    Every finished write is recorded in `completed` (see `pop_completed()`), with
+        blocking_sec: time spent in `save()` by the training loop (snapshot, waiting for a queued write)
+        write_sec: time from `save()` until the file is written
+    """
+    def __init__(self, max_pending=1):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint_writer")
+        self.pending = []
+        self.completed = []
+        self.pin_memory = torch.cuda.is_available()
+
+    def save(self, state, path, keep=None, alias=None):
+        start_t = perf_counter()
+        self._collect()
+        while len(self.pending) >= self.max_pending:
+            self._collect(wait=True)
+        state = snapshot(state, pin_memory=self.pin_memory)
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()  # (after the copies to pinned memory)
+        blocking_sec = perf_counter() - start_t
+        future = self.executor.submit(self._write, state, path, keep, alias, event, start_t)
+        self.pending.append((future, path, blocking_sec))
+
+    @staticmethod
+    def _write(state, path, keep, alias, event, start_t):
+        if event is not None:
+            event.synchronize()
+        save_checkpoint(state, path, keep=keep, alias=alias)
+        return perf_counter() - start_t
+
+    def _collect(self, wait=False):
+        # record the finished writes (with wait: the oldest pending one, waiting for it if needed)
+        while self.pending and (wait or self.pending[0][0].done()):
+            future, path, blocking_sec = self.pending.pop(0)
+            write_sec = future.result()  # (raises the error of the write, if any)
+            self.completed.append({'path': path, 'blocking_sec': blocking_sec, 'write_sec': write_sec})
+            wait = False
+
+    def pop_completed(self):
+        self._collect()
+        completed, self.completed = self.completed, []
+        return completed
+
+    def wait(self):
+        while self.pending:
+            self._collect(wait=True)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+################ END of Resumable Checkpoints ################
@@ -0,0 +1,48 @@
+from time import perf_counter
+
+import torch
+
+
+class RunningMetrics:
+    """
+    Running sums of the metrics of an epoch (loss, accuracy counts, ...), accumulated where they are computed:
+    tensors stay on the device, so a training step never waits for the device to report them.
+    `summary()` brings them to the host all at once, e.g., every `training.log_every_steps` steps and at the
+    end of the epoch, along with the throughput since its previous call (steps/sec and tokens/sec).
+    """
+    def __init__(self):
+        self.sums = {}
+        self.n_steps = 0
+        self._last_steps, self._last_tokens, self._last_time = 0, 0, perf_counter()
+
+    def update(self, n_tokens=0, **values):
+        # values: python numbers or (0-dim) tensors, e.g., loss_sum=loss*batchsize, n_samples=batchsize
+        self.n_steps += 1
+        values['n_tokens'] = n_tokens
+        for k, v in values.items():
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+
+    def summary(self):
+        # the sums as python numbers (a single device-to-host copy), with 'steps_per_sec' and 'tokens_per_sec'
+        summary = dict(self.sums)
+        keys = [k for k, v in summary.items() if torch.is_tensor(v)]
+        if keys:
+            values = torch.stack([summary[k].detach().double() for k in keys]).tolist()
+            summary.update(zip(keys, values))
+
+        now = perf_counter()
+        elapsed = max(now - self._last_time, 1e-9)
+        summary['steps_per_sec'] = (self.n_steps - self._last_steps) / elapsed
+        n_tokens = summary.get('n_tokens', 0)
+        summary['tokens_per_sec'] = (n_tokens - self._last_tokens) / elapsed
+        self._last_steps, self._last_tokens, self._last_time = self.n_steps, n_tokens, now
+        return summary
+
+    def state_dict(self):
+        # (for resumable checkpoints; the throughput is measured again from the resumed step)
+        return {'sums': dict(self.sums), 'n_steps': self.n_steps}
+
+    def load_state_dict(self, state_dict):
+        self.sums = dict(state_dict['sums'])
+        self.n_steps = state_dict['n_steps']
+        self._last_steps, self._last_tokens, self._last_time = self.n_steps, int(self.sums.get('n_tokens', 0)), perf_counter()
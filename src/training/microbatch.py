@@ -0,0 +1,70 @@
+import torch
+
+
+################ Gradient Accumulation ################
+# `training.gradient_accumulation_steps` / `training.max_tokens_per_microbatch`: run.py splits every training batch
+# (`training.batch_size_train` examples, one optimizer step) into micro-batches whose gradients are accumulated.
+# Each micro-batch loss is weighted by its share of the label tokens of the batch, so the accumulated gradient
+# is the one of the (token-averaged) loss of the whole batch.
+
+
+def count_label_tokens(labels, shift_labels=True):
+    # number of tokens in the loss (decoder-only models predict labels[..., 1:])
+    if shift_labels:
+        labels = labels[..., 1:]
+    return (labels != -100).sum()
+
+
+def split_rows(model_inputs, rows, length=None):
+    # rows (a slice or an index tensor) of every input, (..., batch_size, length); with length, drop the columns
+    # after it (right padding) from the inputs of the same length as input_ids
+    total_length = model_inputs['input_ids'].size(-1)
+    microbatch = {}
+    for k, v in model_inputs.items():
+        v = v[..., rows, :]
+        if length is not None and v.size(-1) == total_length:
+            v = v[..., :length]
+        microbatch[k] = v
+    return microbatch
+
+
+def split_microbatches(model_inputs, n_microbatches=1, max_tokens=None, trim=True, shift_labels=True):
+    """
+    Split a batch of model inputs, (..., batch_size, length), into micro-batches.
+    n_microbatches: the rows are first split into that many chunks of (about) the same number of rows.
+    max_tokens: each chunk is further split by length: its rows are sorted by length (attention_mask) and grouped
+        so that a micro-batch holds at most max_tokens padded tokens (rows x longest length; a row longer than
+        that is a micro-batch of its own), and with `trim`, the right padding after its longest row is dropped.
+        The lengths are read on the host (a device sync per batch).
+    Returns a list of (micro-batch, loss weight), the loss weight being the fraction of the label tokens
+    of the batch in the micro-batch (a 0-dim tensor).
+    """
+    batch_size = model_inputs['input_ids'].size(-2)
+    bounds = torch.linspace(0, batch_size, n_microbatches + 1).round().long().tolist()
+    chunks = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    microbatches = []
+    if max_tokens is None:
+        microbatches = [split_rows(model_inputs, rows) for rows in chunks]
+    else:
+        device = model_inputs['input_ids'].device
+        if 'attention_mask' in model_inputs:
+            lengths = model_inputs['attention_mask'].sum(-1).tolist()
+        else:
+            lengths = [model_inputs['input_ids'].size(-1)] * batch_size
+        for chunk in chunks:
+            order = sorted(range(chunk.start, chunk.stop), key=lambda i: -lengths[i])
+            start = 0
+            for end in range(1, len(order) + 1):
+                # order[start] is the longest row of the micro-batch
+                if end == len(order) or (end + 1 - start) * lengths[order[start]] > max_tokens:
+                    rows = torch.tensor(order[start:end], device=device)
+                    microbatches.append(split_rows(model_inputs, rows, lengths[order[start]] if trim else None))
+                    start = end
+
+    n_label_tokens = [count_label_tokens(microbatch['labels'], shift_labels) for microbatch in microbatches]
+    total = torch.stack(n_label_tokens).sum().clamp(min=1)
+    return [(microbatch, n / total) for microbatch, n in zip(microbatches, n_label_tokens)]
+
+
+################ END of Gradient Accumulation ################